@@ -5,6 +5,7 @@ from shutil import copyfile
 
 from flask import Flask, render_template, request, redirect
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import SQLAlchemyError
 
 NODE_LIST = 'node_list'
@@ -27,14 +28,17 @@ db = SQLAlchemy(app)
 
 from routing.config_routes import config_blueprint
 from cloud_components.request_manager import RequestManager
+from cloud_components.request_scheduler import REQUEST_WORKERS
 
-request_manager = RequestManager()
+# requests of different deployments running at the same time
+request_manager = RequestManager(int(os.environ.get("REQUEST_WORKERS", REQUEST_WORKERS)))
 
 from models.deployment import Deployment
 from models.node import Node
 
 def ensure_tables():
     db.create_all()
+    ensure_columns()
     if Node.query.first():
         return
     try:
@@ -67,12 +71,20 @@ def ensure_tables():
         db.session.rollback()
     db.session.commit()
 
+def ensure_columns():
+    # create_all only creates missing tables, columns added later are added to existing databases here
+    request_columns = [column['name'] for column in inspect(db.engine).get_columns('request_executor')]
+    if 'request_state' not in request_columns:
+        db.session.execute(text('ALTER TABLE request_executor ADD COLUMN request_state VARCHAR'))
+        db.session.commit()
+
 ensure_tables()
 
 prepare_environment()
 from openstack_tools.rally_manager import init_rally
 
 init_rally()
+request_manager.recover()
 
 def get_request_manager():
     return request_manager
@@ -105,6 +117,11 @@ def to_json(obj):
 def compress(request_id):
     from cloud_components.request_executor import RequestExecutor
     re: RequestExecutor = RequestExecutor.query.filter(RequestExecutor.id==request_id).first()
+    if not re:
+        return f"Request {request_id} not found", 404
+    # the experiment of a queued or running request is still archived by its worker
+    if get_request_manager().is_scheduled(re.id):
+        return f"Request {request_id} is not finished", 409
     from openstack_tools import rally_manager
     rally_manager.compress_output_data(re.deploy_id, re.get_task_name())
     from datetime import datetime
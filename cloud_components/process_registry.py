@@ -0,0 +1,158 @@
+import contextlib
+import contextvars
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# seconds between SIGTERM and SIGKILL of a cancelled process group
+CANCEL_GRACE_PERIOD = 20
+# seconds a killed process group is waited for before it is given up
+KILL_TIMEOUT = 10
+GROUP_POLL_INTERVAL = 0.1
+
+CURRENT_REQUEST = contextvars.ContextVar('current_request', default=None)
+PROCESSES_DICT = {}
+CANCELLED_REQUESTS = set()
+REGISTRY_LOCK = threading.Lock()
+
+
+class RequestCancelled(Exception):
+    """The request the current work belongs to was cancelled."""
+
+
+@contextlib.contextmanager
+def request_context(request_id):
+    """Attributes the processes started by the calling thread to the request."""
+    token = CURRENT_REQUEST.set(request_id)
+    try:
+        yield
+    finally:
+        CURRENT_REQUEST.reset(token)
+
+
+def bind_context(function):
+    """Wraps `function` to run in the request context of the caller, for work handed to other threads."""
+    context = contextvars.copy_context()
+    # a context can not be entered by two threads at once, every call runs in its own copy
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+def is_cancelled(request_id):
+    return request_id in CANCELLED_REQUESTS
+
+
+def check_cancelled():
+    request_id = CURRENT_REQUEST.get()
+    if request_id is not None and is_cancelled(request_id):
+        raise RequestCancelled(f'Request {request_id} was cancelled')
+
+
+@contextlib.contextmanager
+def registered(process):
+    """Kills `process` and its process group when the current request is cancelled while it runs.
+
+    The process has to lead its own process group, the children it starts are
+    then terminated along with it.
+    """
+    request_id = CURRENT_REQUEST.get()
+    if request_id is None:
+        yield
+        return
+    with REGISTRY_LOCK:
+        PROCESSES_DICT.setdefault(request_id, set()).add(process)
+        cancelled = request_id in CANCELLED_REQUESTS
+    if cancelled:
+        terminate_group(process, signal.SIGKILL)
+    try:
+        yield
+    finally:
+        if is_cancelled(request_id):
+            # the work of the request only ends when its process tree is gone
+            wait_group(process)
+        with REGISTRY_LOCK:
+            PROCESSES_DICT.get(request_id, set()).discard(process)
+
+
+def run(args, input=None, capture_output=False, check=False, **kwargs):
+    """subprocess.run for the work of a request.
+
+    The process runs in a new session, so cancelling the request tears down its
+    whole process tree. RequestCancelled is raised instead of starting a process
+    for a cancelled request, and after a process of one ends.
+    """
+    check_cancelled()
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    with subprocess.Popen(args, start_new_session=True, **kwargs) as process:
+        with registered(process):
+            stdout, stderr = process.communicate(input)
+    check_cancelled()
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def cancel(request_id):
+    """Marks the request cancelled and sends SIGTERM to its process groups.
+
+    The thread running the request waits for the groups to exit and kills them
+    after CANCEL_GRACE_PERIOD, see registered.
+    """
+    with REGISTRY_LOCK:
+        CANCELLED_REQUESTS.add(request_id)
+        processes = list(PROCESSES_DICT.get(request_id, set()))
+    for process in processes:
+        terminate_group(process, signal.SIGTERM)
+    return len(processes)
+
+
+def forget(request_id):
+    """Drops the state of a request whose work has ended."""
+    with REGISTRY_LOCK:
+        CANCELLED_REQUESTS.discard(request_id)
+        PROCESSES_DICT.pop(request_id, None)
+
+
+def wait_group(process):
+    """Waits for the process group of `process` to exit, SIGKILL follows after CANCEL_GRACE_PERIOD."""
+    deadline = time.monotonic() + CANCEL_GRACE_PERIOD
+    killed = False
+    while group_exists(process):
+        if hasattr(process, 'join'):
+            # a multiprocessing worker leading the group is reaped here
+            process.join(GROUP_POLL_INTERVAL)
+        else:
+            time.sleep(GROUP_POLL_INTERVAL)
+        if time.monotonic() < deadline:
+            continue
+        if killed:
+            logging.warning(f'Process group {process.pid} is still alive after SIGKILL')
+            return
+        terminate_group(process, signal.SIGKILL)
+        killed = True
+        deadline = time.monotonic() + KILL_TIMEOUT
+
+
+def group_exists(process):
+    try:
+        os.killpg(process.pid, 0)
+    except (ProcessLookupError, TypeError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def terminate_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError, TypeError):
+        return
+    except OSError as e:
+        logging.warning(f'Sending {sig} to process group {process.pid} failed: {e}')
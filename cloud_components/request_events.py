@@ -0,0 +1,153 @@
+import collections
+import os
+import threading
+import time
+
+# request events kept per deployment for clients that reconnect
+EVENT_HISTORY = 200
+# the most bytes of a log sent in one event
+LOG_CHUNK_SIZE = 64 * 1024
+POLL_INTERVAL = 1
+HEARTBEAT_INTERVAL = 15
+# a stream ends after this many seconds, the client reconnects with its Last-Event-ID
+STREAM_LIFETIME = 120
+RECONNECT_DELAY_MS = 2000
+EVENT_REQUEST = "request"
+
+EVENTS_CONDITION = threading.Condition()
+# deploy_id -> deque of (sequence, data)
+EVENTS_DICT = {}
+# deploy_id -> sequence of the newest event dropped from its history
+TRIMMED_DICT = {}
+SEQUENCE_DICT = {'value': 0}
+# sequences start from 0 again in a restarted process, ids of an older one are not resumed
+STREAM_EPOCH = str(int(time.time()))
+
+
+def publish(deploy_id, data):
+    """Pushes a request event, the JSON of the request, to the streams of the deployment."""
+    with EVENTS_CONDITION:
+        SEQUENCE_DICT['value'] += 1
+        events = EVENTS_DICT.setdefault(deploy_id, collections.deque(maxlen=EVENT_HISTORY))
+        if len(events) == events.maxlen:
+            TRIMMED_DICT[deploy_id] = events[0][0]
+        events.append((SEQUENCE_DICT['value'], data))
+        EVENTS_CONDITION.notify_all()
+
+
+def open_stream(deploy_id, log_files, last_event_id=None, log_offsets=None, snapshot=None):
+    """Returns the server-sent event stream of a deployment.
+
+    The stream carries request events and the lines appended to `log_files`
+    ({event name: path}), one event per log chunk named after the log. Every
+    event id holds the request event sequence and the offsets of all logs, so a
+    client reconnecting with Last-Event-ID continues where it stopped. Logs are
+    sent from `log_offsets` or from their current end. `snapshot` returns the
+    current request events, sent when the stream can not be resumed from the
+    event history.
+    """
+    epoch, sequence, offsets = parse_event_id(last_event_id, list(log_files))
+    for name, path in log_files.items():
+        if offsets.get(name) is None:
+            offsets[name] = (log_offsets or {}).get(name)
+        if offsets[name] is None:
+            offsets[name] = os.path.getsize(path) if os.path.exists(path) else 0
+    with EVENTS_CONDITION:
+        resumable = epoch == STREAM_EPOCH and sequence is not None \
+            and TRIMMED_DICT.get(deploy_id, 0) <= sequence <= SEQUENCE_DICT['value']
+        if not resumable:
+            sequence = SEQUENCE_DICT['value']
+    initial_events = snapshot() if snapshot and not resumable else list()
+    return generate_events(deploy_id, sequence, initial_events, log_files, offsets)
+
+
+def generate_events(deploy_id, sequence, initial_events, log_files, offsets):
+    yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+    for data in initial_events:
+        yield format_event(EVENT_REQUEST, data, build_event_id(sequence, log_files, offsets))
+    started = time.monotonic()
+    last_sent = started
+    while time.monotonic() - started < STREAM_LIFETIME:
+        sent = False
+        for event_sequence, data in events_after(deploy_id, sequence):
+            sequence = event_sequence
+            yield format_event(EVENT_REQUEST, data, build_event_id(sequence, log_files, offsets))
+            sent = True
+        backlog = False
+        for name, path in log_files.items():
+            chunk, offsets[name], more = read_log_chunk(path, offsets[name])
+            if chunk:
+                yield format_event(name, chunk, build_event_id(sequence, log_files, offsets))
+                sent = True
+            backlog = backlog or more
+        now = time.monotonic()
+        if sent:
+            last_sent = now
+        elif now - last_sent >= HEARTBEAT_INTERVAL:
+            # comment lines keep proxies from closing an idle stream
+            yield ": heartbeat\n\n"
+            last_sent = now
+        if not backlog:
+            wait_events(deploy_id, sequence, POLL_INTERVAL)
+
+
+def events_after(deploy_id, sequence):
+    with EVENTS_CONDITION:
+        return [event for event in EVENTS_DICT.get(deploy_id, ()) if event[0] > sequence]
+
+
+def wait_events(deploy_id, sequence, timeout):
+    """Blocks until the deployment has an event after `sequence`, at most `timeout` seconds.
+
+    Events of other deployments wake the waiting streams, but only the newest
+    event of this deployment ends the wait.
+    """
+    def has_events():
+        events = EVENTS_DICT.get(deploy_id)
+        return bool(events) and events[-1][0] > sequence
+    with EVENTS_CONDITION:
+        return EVENTS_CONDITION.wait_for(has_events, timeout)
+
+
+def read_log_chunk(path, offset):
+    """Reads the complete lines appended to the log after `offset`.
+
+    Returns (text or None, new offset, whether more bytes are waiting).
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None, offset, False
+    if size < offset:
+        # truncated or written again from the start
+        offset = 0
+    if size == offset:
+        return None, offset, False
+    with open(path, 'rb') as log_file:
+        log_file.seek(offset)
+        data = log_file.read(LOG_CHUNK_SIZE)
+    line_end = data.rfind(b'\n')
+    if line_end >= 0:
+        data = data[:line_end + 1]
+    elif len(data) < LOG_CHUNK_SIZE:
+        # the last line is still being written
+        return None, offset, False
+    offset = offset + len(data)
+    return data.decode(errors='replace'), offset, size > offset
+
+
+def format_event(event, data, event_id):
+    lines = data[:-1] if data.endswith('\n') else data
+    return f"event: {event}\nid: {event_id}\n" + "".join(f"data: {line}\n" for line in lines.split('\n')) + "\n"
+
+
+def build_event_id(sequence, log_files, offsets):
+    return ".".join([STREAM_EPOCH, str(sequence)] + [str(offsets[name]) for name in log_files])
+
+
+def parse_event_id(event_id, log_names):
+    """Returns (epoch, sequence, {log name: offset}) of an event id, nothing of a malformed one."""
+    parts = event_id.split(".") if event_id else list()
+    if len(parts) != len(log_names) + 2 or not all(part.isdigit() for part in parts):
+        return None, None, {}
+    return parts[0], int(parts[1]), {name: int(offset) for name, offset in zip(log_names, parts[2:])}
@@ -6,12 +6,20 @@ from time import sleep
 import app
 import utils
 from app import db
+from cloud_components import process_registry, request_events, resource_locks
 
 FOLDER_REQUEST_HISTORY = "request_history/"
 
 
 class RequestExecutor (db.Model):
 
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+    STATE_INTERRUPTED = "interrupted"
+    STATE_CANCELLED = "cancelled"
+
     id = db.Column(db.Integer, primary_key=True)
     deploy_id = db.Column(db.Integer, db.ForeignKey('deployment.id'), nullable=False)
     request_time = db.Column(db.DateTime, default=datetime.now)
@@ -19,6 +27,7 @@ class RequestExecutor (db.Model):
     request_start = db.Column(db.DateTime)
     request_end = db.Column(db.DateTime)
     request_kwargs = db.Column(db.String)
+    request_state = db.Column(db.String, default=STATE_QUEUED)
 
     def __init__(self, **kwargs):
         super(RequestExecutor, self).__init__(**kwargs)
@@ -33,13 +42,34 @@ class RequestExecutor (db.Model):
     REQUEST_CLEAN = "request_clean"
     REQUEST_NODE_RESTART = "request_node_restart"
 
+    RESOURCE_CONTROL = "control"
+    RESOURCE_RALLY = "rally"
+    RESOURCE_NODE = "node"
+    LOCK_SHARED = resource_locks.LOCK_SHARED
+    LOCK_EXCLUSIVE = resource_locks.LOCK_EXCLUSIVE
+
     def execute(self):
         logging.info(f'Deploy {self.deploy_id} executing request {self.request_type}')
-        self.request_start = datetime.now()
-        self.save()
-        self.executors_mapping[self.request_type](self)
-        self.request_end = datetime.now()
+        # a resumed request keeps its start, the experiment folder is named after it
+        if not self.request_start:
+            self.request_start = datetime.now()
+        self.request_state = RequestExecutor.STATE_RUNNING
         self.save()
+        request_events.publish(self.deploy_id, self.to_string())
+        self.request_state = RequestExecutor.STATE_FAILED
+        try:
+            with process_registry.request_context(self.id):
+                self.executors_mapping[self.request_type](self)
+            self.request_state = RequestExecutor.STATE_DONE
+        except process_registry.RequestCancelled:
+            logging.info(f'Config {self.deploy_id} request {self.request_type} was cancelled')
+        finally:
+            if process_registry.is_cancelled(self.id):
+                self.request_state = RequestExecutor.STATE_CANCELLED
+            # a failed request is finished as well, it must not hold the queue of the deployment
+            self.request_end = datetime.now()
+            self.save()
+            request_events.publish(self.deploy_id, self.to_string())
         logging.info(f'Config {self.deploy_id} execution of {self.request_type} finished')
 
     def get_id(self):
@@ -48,6 +78,10 @@ class RequestExecutor (db.Model):
     def is_done(self):
         return self.request_end != None
 
+    def is_resumable(self):
+        # requests that can be started again after the process died while they ran
+        return self.request_type in RequestExecutor.RESUMABLE_REQUESTS
+
     def get_task_name(self):
         return self.request_start.strftime(utils.TIME_TO_TASK_NAME)
 
@@ -57,6 +91,7 @@ class RequestExecutor (db.Model):
              'deploy_id': self.deploy_id,
              'request_type': self.request_type,
              'request_kwargs': self.request_kwargs,
+             'request_state': self.request_state,
              'request_time': self.request_time.strftime(utils.DATETIME_FORMAT) if self.request_time else "None",
              'request_start': self.request_start.strftime(utils.DATETIME_FORMAT) if self.request_start else "None",
              'request_end': self.request_end.strftime(utils.DATETIME_FORMAT) if self.request_end else "None"}
@@ -89,7 +124,7 @@ class RequestExecutor (db.Model):
     def __generate_load__(self):
         kwargs = self.get_kwargs_dictionary()
         from openstack_tools.experiment_manager import ExperimentManager
-        experiment = ExperimentManager(self.deploy_id, self.get_task_name(), kwargs)
+        experiment = ExperimentManager(self.deploy_id, self.get_task_name(), kwargs, self.request_start)
         experiment.execute()
 
     def __node_restart__(self):
@@ -97,11 +132,39 @@ class RequestExecutor (db.Model):
         from openstack_tools import openstack_manager
         openstack_manager.node_restart(self.deploy_id, kwargs)
 
+    def get_resources(self):
+        """Resources the request works on, {(resource, id): lock mode}.
+
+        Every request uses the control plane of its deployment, the requests
+        changing the whole deployment use it exclusively. Rally loads and clean
+        ups use the Rally deployment exclusively and every node of the deployment
+        shared, a restart its node exclusively.
+        """
+        control_plane = (RequestExecutor.RESOURCE_CONTROL, self.deploy_id)
+        if self.request_type in RequestExecutor.LIFECYCLE_REQUESTS:
+            return {control_plane: RequestExecutor.LOCK_EXCLUSIVE}
+        resources = {control_plane: RequestExecutor.LOCK_SHARED}
+        if self.request_type in [RequestExecutor.REQUEST_LOAD, RequestExecutor.REQUEST_CLEAN]:
+            resources[(RequestExecutor.RESOURCE_RALLY, self.deploy_id)] = RequestExecutor.LOCK_EXCLUSIVE
+            from models.deployment import Deployment
+            # the load places instances on the nodes, a restart of one of them must wait for it
+            for node in Deployment.load(self.deploy_id).nodes:
+                resources[(RequestExecutor.RESOURCE_NODE, node.name)] = RequestExecutor.LOCK_SHARED
+        if self.request_type == RequestExecutor.REQUEST_NODE_RESTART:
+            resources[(RequestExecutor.RESOURCE_NODE, self.get_kwargs_dictionary()['node'])] = \
+                RequestExecutor.LOCK_EXCLUSIVE
+        return resources
+
     def get_kwargs_dictionary(self):
         return json.loads(self.request_kwargs)
 
     def __test__(self):
         sleep(10)
+        process_registry.check_cancelled()
+
+    LIFECYCLE_REQUESTS = [REQUEST_RESERVE, REQUEST_DEPLOY, REQUEST_DESTROY, REQUEST_DELETE, REQUEST_REDEPLOY]
+    # loads continue from their last finished load
+    RESUMABLE_REQUESTS = [REQUEST_RESERVE, REQUEST_LOAD, REQUEST_TEST, REQUEST_CLEAN, REQUEST_NODE_RESTART]
 
     executors_mapping = {
         REQUEST_RESERVE: __prepare_config__,
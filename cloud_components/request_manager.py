@@ -1,49 +1,57 @@
 import logging
-import threading
+from datetime import datetime
 
 from app import db
 from cloud_components.request_executor import RequestExecutor
-from cloud_components.request_scheduler import RequestScheduler
+from cloud_components.request_scheduler import RequestScheduler, REQUEST_WORKERS
 
 
 class RequestManager:
 
-    def __init__(self):
-        self.__request_schedulers__ = {}
-        self.__schedulers_lock__ = threading.Lock()
-        pass
-
-    def __get_request_scheduler__(self, config_id):
-        self.__schedulers_lock__.acquire()
-        scheduler = self.__request_schedulers__.get(config_id)
-        if scheduler is None:
-            logging.info(f'Request scheduler created for config {config_id}')
-            scheduler = RequestScheduler(config_id)
-            self.__request_schedulers__[config_id] = scheduler
-        self.__schedulers_lock__.release()
-        return scheduler
-
-    def __remove_request_executor(self, config_id):
-        self.__schedulers_lock__.acquire()
-        self.__request_schedulers__.pop(config_id)
-        logging.info(f'Request executor removed from list for config {config_id}')
-        self.__schedulers_lock__.release()
+    def __init__(self, workers=REQUEST_WORKERS):
+        self.__request_scheduler__ = RequestScheduler(workers)
+
+    def recover(self):
+        """Queues the requests a previous run of the process left unfinished again.
+
+        Requests that were running are marked interrupted. Resumable ones are
+        queued again and keep their start, loads continue from their last
+        finished load; the others are finished as interrupted.
+        """
+        unfinished_requests = RequestExecutor.query.filter(RequestExecutor.request_end == None) \
+            .order_by(RequestExecutor.request_time) \
+            .all()
+        for request_executor in unfinished_requests:
+            if request_executor.request_start:
+                request_executor.request_state = RequestExecutor.STATE_INTERRUPTED
+                if not request_executor.is_resumable():
+                    request_executor.request_end = datetime.now()
+                    db.session.commit()
+                    logging.warning(f'Request {request_executor.id} of deployment {request_executor.deploy_id} '
+                                    f'was interrupted and can not be resumed')
+                    continue
+                logging.info(f'Resuming request {request_executor.id} of deployment {request_executor.deploy_id}')
+            db.session.commit()
+            self.__request_scheduler__.submit(request_executor)
 
     def request_action(self, request_executor):
         db.session.add(request_executor)
         db.session.commit()
-        self.__get_request_scheduler__(request_executor.deploy_id).start_executing()
+        self.__request_scheduler__.submit(request_executor)
 
     def get_schedule(self, config_id):
-        return self.__get_request_scheduler__(config_id).get_queued_requests()
+        return self.__request_scheduler__.get_queued_requests(config_id)
 
     def get_current_request(self, config_id):
-        return self.__get_request_scheduler__(config_id).get_current_request()
+        return self.__request_scheduler__.get_current_request(config_id)
 
     def get_request(self, deploy_id, request_id):
         return RequestExecutor.query.\
             filter(RequestExecutor.deploy_id == deploy_id) \
             .filter(RequestExecutor.id == request_id).first()
 
+    def is_scheduled(self, request_id):
+        return self.__request_scheduler__.is_scheduled(request_id)
+
     def cancel_request(self, config_id, request_id):
-        return self.__get_request_scheduler__(config_id).remove_queued_requests(request_id)
+        return self.__request_scheduler__.cancel_requests(config_id, request_id)
@@ -1,76 +1,129 @@
+import bisect
+import logging
 import threading
+from datetime import datetime
 
 from app import db
+from cloud_components import process_registry, request_events, resource_locks
 from cloud_components.request_executor import RequestExecutor
 
+REQUEST_WORKERS = 4
+
 
 class RequestScheduler:
+    """Runs the queued requests of all deployments on a bounded pool of worker threads.
+
+    Requests wait in an in-memory priority queue ordered by request time. A
+    request starts when none of the resources it locks (see
+    RequestExecutor.get_resources) conflicts with a running request or with a
+    request queued before it, so conflicting requests keep their order and
+    independent ones, also of the same deployment, run in parallel. Idle
+    workers wait on a condition variable and are woken up when a request is
+    queued or a running one ends.
+    """
 
-    def __init__(self, config_id):
-        self.deploy_id = config_id
-        self.__executing__ = False
-        self.__executing_lock__ = threading.Lock()
-        self.__current_request_id__ = None
-        self.request_counter = 0
-        pass
+    def __init__(self, workers=REQUEST_WORKERS):
+        self.workers = workers
+        self.condition = threading.Condition()
+        # sorted (request_time, request_id, deploy_id, resources) entries
+        self.queue = list()
+        # request_id -> (deploy_id, resources) of the running requests
+        self.running = {}
+        self.threads = list()
 
-    def start_executing(self):
-        if not self.__executing__:
-            self.__executing_lock__.acquire()
-            self.__executing__ = True
-            self.__executing_lock__.release()
-            thread_destroy = threading.Thread(target=self.__start_executing__, args=[], daemon=True)
-            thread_destroy.start()
+    def submit(self, request_executor):
+        with self.condition:
+            bisect.insort(self.queue, (request_executor.request_time, request_executor.id,
+                                       request_executor.deploy_id, request_executor.get_resources()))
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.__work__, args=[], daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify_all()
+        request_events.publish(request_executor.deploy_id, request_executor.to_string())
 
-    def get_queued_requests(self):
+    def get_queued_requests(self, deploy_id):
         return RequestExecutor.query.filter(RequestExecutor.request_end == None) \
-            .filter(RequestExecutor.deploy_id == self.deploy_id) \
+            .filter(RequestExecutor.deploy_id == deploy_id) \
             .order_by(RequestExecutor.request_time) \
             .all()
 
-    def remove_queued_requests(self, request_id):
-        provided_request = RequestExecutor.query. \
-            filter(RequestExecutor.deploy_id == self.deploy_id) \
-            .filter(RequestExecutor.id == request_id).first()
-        requests_to_delete = RequestExecutor.query. \
-            filter(RequestExecutor.deploy_id == self.deploy_id) \
-            .filter(RequestExecutor.request_time > provided_request.request_time).all()
-        db.session.delete(provided_request)
-        for request in requests_to_delete:
-            db.session.delete(request)
-        db.session.commit()
+    def get_current_request(self, deploy_id):
+        running_requests = self.get_running_requests(deploy_id)
+        return running_requests[0] if running_requests else None
 
-    def get_current_request(self):
-        if (not self.__current_request_id__):
-            return None
+    def get_running_requests(self, deploy_id):
+        running_ids = [request_id for request_id, (running_deploy_id, resources) in list(self.running.items())
+                       if running_deploy_id == deploy_id]
+        if not running_ids:
+            return list()
         return RequestExecutor.query \
-            .filter(RequestExecutor.deploy_id == self.deploy_id) \
-            .filter(RequestExecutor.id == self.__current_request_id__) \
-            .first()
+            .filter(RequestExecutor.deploy_id == deploy_id) \
+            .filter(RequestExecutor.id.in_(running_ids)) \
+            .order_by(RequestExecutor.request_time) \
+            .all()
 
-    def request_now(self, request_executor):
-        thread = threading.Thread(target=request_executor.execute, args=[], daemon=True)
-        thread.start()
+    def is_scheduled(self, request_id):
+        """Whether the request is queued or running."""
+        with self.condition:
+            return request_id in self.running or any(entry[1] == request_id for entry in self.queue)
 
-    # All queued requests are executed till none are found
-    def __start_executing__(self):
-        current_request : RequestExecutor = RequestExecutor.query \
-            .filter(RequestExecutor.deploy_id == self.deploy_id) \
+    def cancel_requests(self, deploy_id, request_id):
+        """Cancels the request and the unfinished requests of the deployment queued after it.
+
+        Queued requests are dropped from the queue and finished as cancelled.
+        The process trees of running ones are terminated (see
+        process_registry.cancel); their workers finish them as cancelled and
+        release their resources once the trees are gone.
+        """
+        provided_request = RequestExecutor.query. \
+            filter(RequestExecutor.deploy_id == deploy_id) \
+            .filter(RequestExecutor.id == request_id).first()
+        if not provided_request:
+            return list()
+        requests_to_cancel = RequestExecutor.query. \
+            filter(RequestExecutor.deploy_id == deploy_id) \
             .filter(RequestExecutor.request_end == None) \
-            .order_by(RequestExecutor.request_time) \
-            .first()
-        try:
-            while current_request:
-                self.__current_request_id__ = current_request.id
-                current_request.execute()
-                current_request = RequestExecutor.query \
-                    .filter(RequestExecutor.deploy_id == self.deploy_id) \
-                    .filter(RequestExecutor.request_end == None) \
-                    .order_by(RequestExecutor.request_time) \
-                    .first()
-                self.__current_request_id__ = None
-        finally:
-            self.__current_request_id__ = None
-        self.__executing_lock__.acquire()
-        self.__executing__ = False
-        self.__executing_lock__.release()
+            .filter(RequestExecutor.request_time >= provided_request.request_time).all()
+        cancelled_ids = {request.id for request in requests_to_cancel}
+        with self.condition:
+            self.queue = [entry for entry in self.queue if entry[1] not in cancelled_ids]
+            running_ids = cancelled_ids & set(self.running)
+            # under the condition, a worker forgets its request only after it left running
+            for running_id in running_ids:
+                logging.info(f'Cancelling running request {running_id} of deployment {deploy_id}')
+                process_registry.cancel(running_id)
+        cancel_time = datetime.now()
+        queued_requests = [request for request in requests_to_cancel if request.id not in running_ids]
+        for request in queued_requests:
+            request.request_state = RequestExecutor.STATE_CANCELLED
+            request.request_end = cancel_time
+        db.session.commit()
+        for request in queued_requests:
+            request_events.publish(deploy_id, request.to_string())
+        return sorted(cancelled_ids)
+
+    def __take_runnable__(self):
+        return resource_locks.take_runnable(self.queue, self.running)
+
+    def __work__(self):
+        while True:
+            with self.condition:
+                entry = self.__take_runnable__()
+                while entry is None:
+                    self.condition.wait()
+                    entry = self.__take_runnable__()
+            request_time, request_id, deploy_id, resources = entry
+            try:
+                current_request = RequestExecutor.query.filter(RequestExecutor.id == request_id).first()
+                # requests removed or finished while queued are skipped
+                if current_request and not current_request.is_done():
+                    current_request.execute()
+            except Exception as e:
+                logging.exception(f'Request {request_id} of deployment {deploy_id} failed: {e}')
+            finally:
+                with self.condition:
+                    del self.running[request_id]
+                    process_registry.forget(request_id)
+                    self.condition.notify_all()
+                db.session.remove()
@@ -0,0 +1,29 @@
+LOCK_SHARED = "shared"
+LOCK_EXCLUSIVE = "exclusive"
+
+
+def take_runnable(queue, running):
+    """Removes and returns the first queued entry that can start, None when every one has to wait.
+
+    `queue` holds sorted (request_time, request_id, deploy_id, resources)
+    entries, `running` maps request ids to (deploy_id, resources). An entry
+    can start when its resources conflict neither with a running request nor
+    with an entry queued before it, so conflicting requests keep their order.
+    """
+    claimed = [resources for deploy_id, resources in running.values()]
+    for index, entry in enumerate(queue):
+        request_time, request_id, deploy_id, resources = entry
+        if not any(conflicts(resources, other) for other in claimed):
+            del queue[index]
+            running[request_id] = (deploy_id, resources)
+            return entry
+        # a waiting request keeps its resources from later requests
+        claimed.append(resources)
+    return None
+
+
+def conflicts(resources, other_resources):
+    """Two requests conflict when they lock a common resource and one of them exclusively."""
+    return any(resource in other_resources
+               and LOCK_EXCLUSIVE in (mode, other_resources[resource])
+               for resource, mode in resources.items())
@@ -17,7 +17,7 @@ class Deployment(db.Model):
 
     RALLY_REPORT_JSON = "rally_report.json"
     RALLY_REPORT_HTML = "rally_report.html"
-    LOG_DUMP = "log_dump.json"
+    LOG_DUMP = "log_dump.ndjson.gz"
 
     OUTPUT_FOLDER = "output/"
     HTML_OUTPUT_FOLDER = "html_reports/"
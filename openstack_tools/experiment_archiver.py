@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils import get_experiment_folder, get_load_folder, get_rally_folder, DATETIME_FORMAT
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_WORKERS = 2
+ARCHIVE_ZSTD_LEVEL = 3
+CONTAINER_EXTENSION = ".tar"
+FILE_ARCHIVE_MANIFEST = "archive_manifest.json"
+
+
+class ExperimentArchiver:
+    """Compresses every load of an experiment as soon as the load is done.
+
+    Loads are packed into zstd compressed tarballs (multithreaded, gzip when
+    zstandard is not installed) on a small worker pool. Each finished load
+    archive is appended to an uncompressed experiment container tarball next to
+    the experiment folder, and recorded in the container manifest. `finalize`
+    only waits for the pending loads and adds the experiment level files, which
+    are replaced when it runs again.
+    """
+
+    def __init__(self, deployment_id, request_name):
+        self.deployment_id = deployment_id
+        self.request_name = request_name
+        self.experiment_folder = get_experiment_folder(deployment_id, request_name)
+        self.container_path = get_container_path(deployment_id, request_name)
+        self.manifest_path = self.experiment_folder + FILE_ARCHIVE_MANIFEST
+        self.manifest = {'request_name': request_name, 'loads': {}}
+        if os.path.exists(self.manifest_path) and os.path.exists(self.container_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS)
+        self.futures = list()
+        self.submitted = set(self.manifest['loads'])
+
+    def archive_load(self, load_name):
+        if load_name in self.submitted:
+            return
+        self.submitted.add(load_name)
+        self.futures.append(self.executor.submit(self.__archive_load__, load_name))
+
+    def finalize(self):
+        for load_name in self.get_load_names():
+            self.archive_load(load_name)
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.__drop_experiment_files__()
+            self.manifest['finalized'] = datetime.now().strftime(DATETIME_FORMAT)
+            with tarfile.open(self.container_path, 'a') as container:
+                self.manifest['files_offset'] = container.offset
+                self.save_manifest()
+                for entry in os.scandir(self.experiment_folder):
+                    if entry.is_file():
+                        container.add(entry.path, arcname=f"{self.request_name}/{entry.name}")
+        return self.container_path
+
+    def get_load_names(self):
+        if not os.path.exists(self.experiment_folder):
+            return list()
+        return sorted(entry.name for entry in os.scandir(self.experiment_folder) if entry.is_dir())
+
+    def __archive_load__(self, load_name):
+        load_folder = get_load_folder(self.deployment_id, self.request_name, load_name)
+        extension = ".tar.zst" if zstandard else ".tar.gz"
+        archive_name = f"{load_name}{extension}"
+        archive_path = self.experiment_folder + archive_name
+        try:
+            if zstandard:
+                compressor = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL, threads=-1)
+                with open(archive_path, 'wb') as archive_file:
+                    with compressor.stream_writer(archive_file) as writer:
+                        with tarfile.open(fileobj=writer, mode='w|') as archive:
+                            archive.add(load_folder, arcname=load_name)
+            else:
+                with tarfile.open(archive_path, 'w:gz') as archive:
+                    archive.add(load_folder, arcname=load_name)
+            with self.lock:
+                self.__drop_experiment_files__()
+                with tarfile.open(self.container_path, 'a') as container:
+                    container.add(archive_path, arcname=f"{self.request_name}/{archive_name}")
+                self.manifest['loads'][load_name] = {'archive': archive_name,
+                                                     'size': os.path.getsize(archive_path),
+                                                     'archived': datetime.now().strftime(DATETIME_FORMAT)}
+                self.save_manifest()
+        except Exception as e:
+            logging.error(f'Archiving {load_folder} failed: {e}')
+            raise
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+
+    def __drop_experiment_files__(self):
+        """Cuts the experiment level files of a previous finalize off the end of the container.
+
+        finalize adds them again, so a resumed or repeated finalize leaves no
+        duplicate members and they always follow the last load.
+        """
+        files_offset = self.manifest.pop('files_offset', None)
+        if files_offset is None or not os.path.exists(self.container_path):
+            return
+        with open(self.container_path, 'r+b') as container_file:
+            container_file.truncate(files_offset)
+            container_file.seek(files_offset)
+            # end of archive marker, tarfile appends in front of it
+            container_file.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        self.save_manifest()
+
+    def save_manifest(self):
+        with open(self.manifest_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+
+
+def get_container_path(deployment_id, request_name):
+    return f"{get_rally_folder(deployment_id)}{request_name}{CONTAINER_EXTENSION}"
@@ -1,62 +1,94 @@
+import json
 import logging
+import os
 import re
-import subprocess
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import random
 
-import jinja2
-from jinja2 import Environment, BaseLoader
-
-from models.deployment import Deployment
-from openstack_tools import rally_manager, metrics_collector
+from cloud_components import process_registry
+from openstack_tools import rally_manager, metrics_collector, log_collector
+from openstack_tools.experiment_archiver import ExperimentArchiver
+from openstack_tools.load_renderer import LoadRenderer
 from openstack_tools.metrics_collector import MetricsCollector
-from utils import get_load_folder
+from openstack_tools.metrics_streamer import MetricsStreamer, STREAM_INTERVAL
+from utils import get_load_folder, get_experiment_folder, read_json_file
 
-RANDOM_NODE_STRING = "[random_node]"
-NODE_LIST_STRING = "[node_list]"
 LOAD_FOLDER_NAME = "load"
+# loads whose post-processing may still be pending while the next load runs
+PIPELINE_DEPTH = 2
+FILE_EXPERIMENT_PROGRESS = "experiment_progress.json"
 
 class ExperimentManager:
-    def __init__(self, deployment_id, request_name, kwargs):
+    def __init__(self, deployment_id, request_name, kwargs, experiment_start=None):
         self.deployment_id = deployment_id
         self.request_name = request_name
+        self.experiment_start = experiment_start or datetime.now()
+        self.progress_path = get_experiment_folder(deployment_id, request_name) + FILE_EXPERIMENT_PROGRESS
         self.duration = kwargs['duration']
         workload_source = kwargs['workload']
         self.use_traces = False
         if 'use_traces' in kwargs:
             if kwargs['use_traces'] == 'on':
                 self.use_traces = True
-        self.workload_template = Environment(loader=BaseLoader).from_string(workload_source)
+        self.metrics_allowlist = kwargs.get('metrics_allowlist')
+        self.metrics_denylist = kwargs.get('metrics_denylist')
+        self.metrics_format = kwargs.get('metrics_format')
+        self.metrics_source = kwargs.get('metrics_source')
+        self.stream_metrics = kwargs.get('stream_metrics') == 'on'
+        self.stream_interval = int(kwargs.get('stream_interval') or STREAM_INTERVAL)
+        self.pipeline_loads = kwargs.get('pipeline_loads') == 'on'
+        self.post_processing = None
+        if self.pipeline_loads:
+            self.post_processing = ThreadPoolExecutor(max_workers=1)
+            self.post_processing_slots = threading.Semaphore(PIPELINE_DEPTH)
+        self.pending_loads = list()
+        self.completed_loads = list()
+        if os.path.exists(self.progress_path):
+            # the experiment was interrupted, loads finished before are kept
+            self.completed_loads = read_json_file(self.progress_path)['completed_loads']
+            rally_manager.prune_load_summaries(deployment_id, request_name, self.completed_loads)
+            logging.info(f'Resuming {request_name} after {len(self.completed_loads)} finished loads')
+        self.renderer = LoadRenderer(deployment_id, workload_source, self.use_traces)
         self.hooks = list()
         for item in kwargs.items():
             if 'anomaly' in item[0]:
                 self.hooks.append(item[1])
+        self.archiver = ExperimentArchiver(deployment_id, request_name)
         rally_manager.create_deployment(deployment_id)
 
     def execute(self):
-        if not self.duration:
-            self.__execute_each_anomaly_once__()
-        else:
-            import re
-            iterations_pattern = "^\d+$"
-            ###TODO improve pattern matching
-            if re.match(iterations_pattern, self.duration):
-                self.__execute_by_iterations__()
+        try:
+            if not self.duration:
+                self.__execute_each_anomaly_once__()
             else:
-                self.__execute_by_time__()
-        rally_manager.compress_output_data(self.deployment_id, self.request_name)
+                import re
+                iterations_pattern = "^\d+$"
+                ###TODO improve pattern matching
+                if re.match(iterations_pattern, self.duration):
+                    self.__execute_by_iterations__()
+                else:
+                    self.__execute_by_time__()
+            self.collect_post_processed(wait=True)
+        finally:
+            self.stop_post_processing()
+        rally_manager.compress_output_data(self.deployment_id, self.request_name, self.archiver)
 
     def __execute_by_iterations__(self):
         iteration = 0
         while (iteration < int(self.duration)):
-            if not self.hooks:
+            if f'load{iteration}' in self.completed_loads:
+                pass
+            elif not self.hooks:
                 self.execute_load(f'load{iteration}')
             else:
                 self.execute_load(f'load{iteration}', random.choice(self.hooks))
             iteration = iteration + 1
 
     def __execute_by_time__(self):
-        self.start_time = datetime.now()
+        self.start_time = self.experiment_start
         h = re.search("^\d+h$", self.duration)
         hours = 0
         if (h):
@@ -70,10 +102,12 @@ class ExperimentManager:
         if (d):
             days = int(d.group()[:-1])
         time_boundary = self.start_time + timedelta(days=days, hours=hours, minutes=minutes)
-        current_time = self.start_time
+        current_time = datetime.now()
         counter = 0
         while current_time < time_boundary:
-            if not self.hooks:
+            if f'load{counter}' in self.completed_loads:
+                pass
+            elif not self.hooks:
                 self.execute_load(f'load{counter}')
             else:
                 self.execute_load(f'load{counter}', random.choice(self.hooks))
@@ -84,64 +118,117 @@ class ExperimentManager:
     def __execute_each_anomaly_once__(self):
         chosen_hook = ""
         if not self.hooks:
-            return self.execute_load()
+            return 'load0' in self.completed_loads or self.execute_load()
         counter = 0
         for hook in self.hooks:
-            if not self.execute_load(f'counter{counter}', hook):
+            if f'counter{counter}' in self.completed_loads:
+                pass
+            elif not self.execute_load(f'counter{counter}', hook):
                 return False
             counter = counter + 1
         return True
 
     def extract_openstack_logs(self, load_name):
         load_folder = get_load_folder(self.deployment_id, self.request_name, load_name)
-
-        file_log = open(f"{load_folder}experiment_log", "a")
-
-        bootstrap_ansible_cmd = ["ansible-playbook",
-                                 "--inventory", f"{load_folder}/multinode", '-vvvv',
-                                 f"rally_files/collect_openstack_logs.yaml"]
-        try:
-            subprocess.run(bootstrap_ansible_cmd, stdout=file_log)
-        except subprocess.CalledProcessError as e:
-            logging.error("Pre-bootstrapping failed. Check {} for additional information. Error code: {}. "
-                          "Error message {}", file_log, e.returncode, e.output)
+        with open(f"{load_folder}experiment_log", "a") as file_log:
+            index = log_collector.collect_openstack_logs(self.deployment_id, load_folder, file_log)
+        logging.info(f'Collected {sum(len(segments) for segments in index.values())} log segments '
+                     f'from {len(index)} hosts for {load_folder}')
 
     def execute_load(self, load_name = 'load0', hook=""):
-        hook_template = Environment(loader=BaseLoader).from_string(hook)
-        hook_source = hook_template.render()
-
-        deployment: Deployment = Deployment.load(self.deployment_id)
-        random_domain_name = f'"{random.choice(deployment.nodes).domain}"'
-        hook_source = hook_source.replace(RANDOM_NODE_STRING, random_domain_name)
-
-        node_list = "["
-        for node in deployment.nodes:
-            node_list += f'"{node.domain}"'
-            if not node == deployment.nodes[-1]:
-                node_list += ','
-        node_list += "]"
-        hook_source = hook_source.replace(NODE_LIST_STRING, node_list)
-
-        workload = self.workload_template.render() + '\n' + hook_source
-
-        templateLoader = jinja2.FileSystemLoader(searchpath="./rally_files")
-        templateEnv = jinja2.Environment(loader=templateLoader)
-        TEMPLATE_FILE = "rally.conf"
-        template = templateEnv.get_template(TEMPLATE_FILE)
-        rally_config = template.render(use_traces=self.use_traces)
+        process_registry.check_cancelled()
+        load_folder = get_load_folder(self.deployment_id, self.request_name, load_name)
+        if os.path.exists(load_folder):
+            # left over by an interrupted run of the load
+            shutil.rmtree(load_folder)
+        workload = self.renderer.render_workload(hook)
+        rally_config = self.renderer.rally_config
 
         start_time = datetime.now()
-        task_done = rally_manager.run_load(self.deployment_id, self.request_name, load_name, workload, rally_config)
+        metrics_streamer = None
+        if self.stream_metrics:
+            metrics_streamer = MetricsStreamer(self.deployment_id, self.request_name, load_name, start_time,
+                                               self.metrics_allowlist, self.metrics_denylist,
+                                               self.metrics_source, self.stream_interval)
+            metrics_streamer.start_streaming()
+        try:
+            task_done = rally_manager.run_load(self.deployment_id, self.request_name, load_name, workload,
+                                               rally_config)
+        finally:
+            end_time = datetime.now()
+            if metrics_streamer:
+                metrics_streamer.stop(end_time)
         if not task_done:
             return False
-        end_time = datetime.now()
+        if not self.post_processing:
+            self.post_process_load(load_name, start_time, end_time, metrics_streamer is not None)
+            self.mark_completed(load_name)
+            return True
+        # log offsets move on with the next load, the segments of this one are pulled before it starts
+        self.extract_openstack_logs(load_name)
+        # blocks while PIPELINE_DEPTH loads still wait for their post-processing
+        self.post_processing_slots.acquire()
+        # post-processing runs in the request context, its processes end with a cancelled request
+        future = self.post_processing.submit(process_registry.bind_context(self.__post_process_in_pipeline__),
+                                             load_name, start_time, end_time, metrics_streamer is not None)
+        self.pending_loads.append((load_name, future))
+        self.collect_post_processed()
+        return True
+
+    def __post_process_in_pipeline__(self, load_name, start_time, end_time, streamed):
+        try:
+            self.post_process_load(load_name, start_time, end_time, streamed, collect_logs=False)
+        finally:
+            self.post_processing_slots.release()
+
+    def collect_post_processed(self, wait=False):
+        """Marks pipelined loads completed in load order, errors of a load are raised here."""
+        while self.pending_loads and (wait or self.pending_loads[0][1].done()):
+            load_name, future = self.pending_loads.pop(0)
+            future.result()
+            self.mark_completed(load_name)
+            logging.info(f'Post-processing of {load_name} of {self.request_name} done')
+
+    def stop_post_processing(self):
+        """Cancels the pipelined post-processing not started yet and waits for the running one.
+
+        Errors of loads not collected, after the experiment failed or was
+        cancelled, are logged.
+        """
+        if not self.post_processing:
+            return
+        self.post_processing.shutdown(wait=True, cancel_futures=True)
+        for load_name, future in self.pending_loads:
+            if not future.cancelled() and future.exception():
+                logging.error(f'Post-processing of {load_name} of {self.request_name} failed: '
+                              f'{future.exception()}')
+        self.pending_loads = list()
+
+    def mark_completed(self, load_name):
+        self.completed_loads.append(load_name)
+        with open(self.progress_path, "w") as progress_file:
+            json.dump({'completed_loads': self.completed_loads}, progress_file)
+
+    def post_process_load(self, load_name, start_time, end_time, streamed, collect_logs=True):
+        """Extracts traces, logs and metrics of a load for its own time window.
+
+        Pipelined loads collect their OpenStack log segments before, see execute_load.
+        """
         if self.use_traces:
             rally_manager.extract_traces(self.deployment_id, self.request_name, load_name)
         rally_manager.extract_logs(self.deployment_id, self.request_name, load_name, start_time, end_time)
         print([self.deployment_id, self.request_name, load_name, start_time,
                                           end_time])
-        metrics_collector = MetricsCollector(self.deployment_id, self.request_name, load_name, start_time,
-                                          end_time)
-        metrics_collector.extract_metrics()
-        self.extract_openstack_logs(load_name)
-        return True
\ No newline at end of file
+        if streamed:
+            metrics_collector = MetricsCollector.from_raw_store(self.deployment_id, self.request_name, load_name,
+                                                                self.metrics_allowlist, self.metrics_denylist,
+                                                                self.metrics_format)
+            metrics_collector.rebuild_metrics()
+        else:
+            metrics_collector = MetricsCollector(self.deployment_id, self.request_name, load_name, start_time,
+                                                 end_time, self.metrics_allowlist, self.metrics_denylist,
+                                                 self.metrics_format, metrics_source=self.metrics_source)
+            metrics_collector.extract_metrics()
+        if collect_logs:
+            self.extract_openstack_logs(load_name)
+        self.archiver.archive_load(load_name)
@@ -0,0 +1,40 @@
+import random
+
+import jinja2
+from jinja2 import Environment, BaseLoader
+
+from models.deployment import Deployment
+
+RANDOM_NODE_STRING = "[random_node]"
+NODE_LIST_STRING = "[node_list]"
+RALLY_TEMPLATE_FOLDER = "./rally_files"
+RALLY_CONFIG_TEMPLATE = "rally.conf"
+
+
+class LoadRenderer:
+    """Renders the Rally task and config of every load of one experiment.
+
+    The workload and hook templates are compiled once, the Rally config is
+    rendered once and the node list of the deployment is read once, so a load
+    only renders its templates and picks its random node.
+    """
+
+    def __init__(self, deployment_id, workload_source, use_traces):
+        self.environment = Environment(loader=BaseLoader)
+        self.workload_template = self.environment.from_string(workload_source)
+        self.hook_templates = {}
+        deployment: Deployment = Deployment.load(deployment_id)
+        self.node_domains = [node.domain for node in deployment.nodes]
+        self.node_list = "[" + ",".join(f'"{domain}"' for domain in self.node_domains) + "]"
+        config_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=RALLY_TEMPLATE_FOLDER))
+        self.rally_config = config_environment.get_template(RALLY_CONFIG_TEMPLATE).render(use_traces=use_traces)
+
+    def render_hook(self, hook):
+        if hook not in self.hook_templates:
+            self.hook_templates[hook] = self.environment.from_string(hook)
+        hook_source = self.hook_templates[hook].render()
+        hook_source = hook_source.replace(RANDOM_NODE_STRING, f'"{random.choice(self.node_domains)}"')
+        return hook_source.replace(NODE_LIST_STRING, self.node_list)
+
+    def render_workload(self, hook=""):
+        return self.workload_template.render() + '\n' + self.render_hook(hook)
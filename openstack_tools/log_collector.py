@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+import tarfile
+
+import utils
+from cloud_components import process_registry
+from utils import get_deployment_folder, read_json_file
+
+LOG_COLLECTION_PLAYBOOK = "rally_files/collect_openstack_log_segments.yaml"
+OPENSTACK_LOGS_FOLDER = "openstack_logs/"
+FILE_LOG_OFFSETS = "log_offsets.json"
+FILE_LOG_INDEX = "index.json"
+FILE_LOG_COLLECTION_VARS = "log_collection_vars.json"
+SEGMENT_ARCHIVE_EXTENSION = ".tar.gz"
+# written by collect_log_segments.py into every host archive
+SEGMENT_INDEX_MEMBER = "index.json"
+
+
+def collect_openstack_logs(deployment_id, load_folder, file_log):
+    """Pulls only the kolla log bytes appended since the previous load of the deployment.
+
+    Every host packs the new bytes of each log file into openstack_logs/<host>.tar.gz
+    of the load. openstack_logs/index.json points every segment back to its
+    source file and byte range. The offsets read up to are kept per deployment,
+    a host that failed to deliver is collected from its old offsets next time.
+    """
+    offsets_path = get_deployment_folder(deployment_id) + FILE_LOG_OFFSETS
+    offsets = read_json_file(offsets_path) if os.path.exists(offsets_path) else {}
+    vars_path = load_folder + FILE_LOG_COLLECTION_VARS
+    with open(vars_path, "w") as vars_file:
+        json.dump({"load_dir": os.path.abspath(load_folder), "log_offsets": offsets}, vars_file)
+    collect_ansible_cmd = ["ansible-playbook",
+                           "--inventory", f"{load_folder}multinode",
+                           "--extra-vars", f"@{vars_path}",
+                           LOG_COLLECTION_PLAYBOOK]
+    try:
+        process_registry.run(collect_ansible_cmd, stdout=file_log)
+    finally:
+        os.remove(vars_path)
+
+    logs_folder = load_folder + OPENSTACK_LOGS_FOLDER
+    utils.ensure_folder(logs_folder)
+    index = {}
+    for entry in sorted(os.scandir(logs_folder), key=lambda entry: entry.name):
+        if not entry.name.endswith(SEGMENT_ARCHIVE_EXTENSION):
+            continue
+        host = entry.name[:-len(SEGMENT_ARCHIVE_EXTENSION)]
+        try:
+            with tarfile.open(entry.path) as archive:
+                host_index = json.load(archive.extractfile(SEGMENT_INDEX_MEMBER))
+        except (tarfile.TarError, KeyError, ValueError) as e:
+            logging.error(f'Log segments of {host} in {logs_folder} are unreadable: {e}')
+            continue
+        offsets[host] = host_index['offsets']
+        index[host] = [dict(segment, archive=entry.name) for segment in host_index['segments']]
+    with open(logs_folder + FILE_LOG_INDEX, "w") as index_file:
+        json.dump(index, index_file, indent=2)
+    with open(offsets_path, "w") as offsets_file:
+        json.dump(offsets, offsets_file)
+    return index
@@ -0,0 +1,75 @@
+import gzip
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cloud_components import process_registry
+
+LOG_INDEX = "flog-*"
+EXPORT_PAGE_SIZE = 5000
+EXPORT_SLICES = 4
+EXPORT_SCROLL_TIME = "5m"
+EXPORT_TIMEOUT = 300
+
+
+def export_logs(elasticsearch_url, query, output_path, slices=EXPORT_SLICES):
+    """Dumps every log hit matching `query` to a gzip compressed NDJSON file.
+
+    The index is read with a sliced scroll, one worker per slice, and every
+    worker streams its pages into its own gzip member. The members are joined
+    into `output_path`, which stays a single valid gzip file. Each line is a
+    hit as elasticdump wrote it. Returns the number of exported hits.
+    """
+    part_paths = [f"{output_path}.part{slice_id}" for slice_id in range(slices)]
+    session = requests.Session()
+    # the slices stop at their next page once the request is cancelled
+    export = process_registry.bind_context(export_slice)
+    try:
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            counts = list(executor.map(lambda slice_id: export(session, elasticsearch_url, query, slice_id,
+                                                               slices, part_paths[slice_id]),
+                                       range(slices)))
+        with open(output_path, "wb") as output_file:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, output_file)
+    finally:
+        session.close()
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    return sum(counts)
+
+
+def export_slice(session, elasticsearch_url, query, slice_id, slices, part_path):
+    body = {"query": query, "size": EXPORT_PAGE_SIZE, "sort": ["_doc"]}
+    if slices > 1:
+        body["slice"] = {"id": slice_id, "max": slices}
+    response = session.post(f"{elasticsearch_url}/{LOG_INDEX}/_search", params={"scroll": EXPORT_SCROLL_TIME},
+                            json=body, timeout=EXPORT_TIMEOUT)
+    response.raise_for_status()
+    page = response.json()
+    scroll_id = page.get("_scroll_id")
+    count = 0
+    try:
+        with gzip.open(part_path, "wt") as part_file:
+            while page["hits"]["hits"]:
+                for hit in page["hits"]["hits"]:
+                    hit.pop("sort", None)
+                    part_file.write(json.dumps(hit) + "\n")
+                count = count + len(page["hits"]["hits"])
+                process_registry.check_cancelled()
+                response = session.post(f"{elasticsearch_url}/_search/scroll",
+                                        json={"scroll": EXPORT_SCROLL_TIME, "scroll_id": scroll_id},
+                                        timeout=EXPORT_TIMEOUT)
+                response.raise_for_status()
+                page = response.json()
+                scroll_id = page.get("_scroll_id", scroll_id)
+    finally:
+        if scroll_id:
+            session.delete(f"{elasticsearch_url}/_search/scroll", json={"scroll_id": [scroll_id]},
+                           timeout=EXPORT_TIMEOUT)
+    return count
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+TIMESTAMP_COLUMN = 'timestamp'
+
+
+class MetricFrameBuilder:
+    """Collects metric series per key and builds each frame in a single pass.
+
+    Series are only buffered by `add`; `build` aligns all series of a key on the
+    union of their timestamps with one concat, instead of merging the frame
+    column by column.
+    """
+
+    def __init__(self):
+        self.series = {}
+
+    def add(self, key, title, values):
+        timestamps, metric_values = series_arrays(values)
+        # a repeated title replaces the previous column, as an assignment would
+        self.series.setdefault(key, {})[title] = pd.Series(metric_values, index=timestamps, name=title, copy=False)
+
+    def keys(self):
+        return list(self.series.keys())
+
+    def build(self, key):
+        columns = self.series.pop(key, None)
+        if not columns:
+            return pd.DataFrame()
+        dt = pd.concat(list(columns.values()), axis=1, copy=False).sort_index()
+        dt.index.name = TIMESTAMP_COLUMN
+        return dt.reset_index()
+
+
+def series_values(submetric):
+    """Values of a query_range series, or the (timestamps, values) arrays of a remote read series."""
+    if 'samples' in submetric:
+        return submetric['timestamps'], submetric['samples']
+    return submetric['values']
+
+
+def series_arrays(values):
+    """Splits Prometheus [[timestamp, "value"], ...] pairs into numpy arrays."""
+    if isinstance(values, tuple):
+        timestamps, metric_values = values
+        return pd.Index(np.asarray(timestamps, dtype=np.float64), name=TIMESTAMP_COLUMN), \
+            np.asarray(metric_values, dtype=np.float64)
+    timestamps = np.fromiter((value[0] for value in values), dtype=np.float64, count=len(values))
+    metric_values = np.fromiter((value[1] for value in values), dtype=np.float64, count=len(values))
+    return pd.Index(timestamps, name=TIMESTAMP_COLUMN), metric_values
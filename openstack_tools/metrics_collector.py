@@ -1,33 +1,68 @@
+import collections
 import csv
 import json
-import pandas as pd
-
-import requests
+import logging
+import re
+import shutil
+from datetime import datetime
 
 import utils
+from cloud_components import process_registry
 from models.deployment import Deployment
 from models.node import Node
+from openstack_tools.metric_frame_builder import MetricFrameBuilder, series_values
+from openstack_tools.prometheus_fetcher import PrometheusFetcher
+from openstack_tools.prometheus_remote_read import RemoteReader, MATCH_REGEXP
+from openstack_tools.raw_metrics_store import RawMetricsStore, RECORD_CUSTOM, RECORD_METRIC, metric_instances
 from utils import *
 
 FOLDER_NO_NAME = "metric_no_name"
 METRIC_NO_NAME = "node"
 METRIC_COLLECTION_STEP = 10
+METRIC_JOBS = ['cadvisor', 'node']
+SOURCE_QUERY_RANGE = "query_range"
+SOURCE_REMOTE_READ = "remote_read"
+OUTPUT_CSV = "csv"
+OUTPUT_PARQUET = "parquet"
+PARQUET_COMPRESSION = "zstd"
+FILE_MANIFEST = "manifest.json"
 metric_labels_excluded = ['__name__', 'instance', 'job']
 
 
 class MetricsCollector:
 
-    def __init__(self, deployment_id, request_name, load_name, start, end):
+    def __init__(self, deployment_id, request_name, load_name, start, end, allowlist=None, denylist=None,
+                 output_format=OUTPUT_CSV, offline=False, metrics_source=SOURCE_QUERY_RANGE):
         self.deployment_id = deployment_id
         self.request_name = request_name
         self.load_name = load_name
         self.start = start
         self.end = end
-
-        self.prometheus_url = self.get_prometheus_url()
+        self.allowlist = parse_metric_patterns(allowlist)
+        self.denylist = parse_metric_patterns(denylist)
+        self.output_format = output_format or OUTPUT_CSV
+        self.manifest = list()
+        self.node_domains = {}
+        self.offline = offline
+        self.remote_matchers = list()
+
+        self.prometheus_url = None
+        self.fetcher = None
+        self.remote_reader = None
+        if not self.offline:
+            self.prometheus_url = self.get_prometheus_url()
+            self.fetcher = PrometheusFetcher(self.prometheus_url, METRIC_COLLECTION_STEP)
+            if metrics_source == SOURCE_REMOTE_READ:
+                self.remote_reader = RemoteReader(self.fetcher)
         self.load_folder = utils.get_load_folder(self.deployment_id, self.request_name, self.load_name)
         self.metrics_folder = self.load_folder + "/labeled_metrics/"
+        self.raw_store = RawMetricsStore(self.load_folder)
 
+        self.anomaly_type = None
+        self.anomaly_start = None
+        self.anomaly_end = None
+
+    def load_anomaly_info(self):
         with open(self.load_folder + Deployment.RALLY_REPORT_JSON) as jsondata:
             self.rally_report_json = json.load(jsondata)
 
@@ -54,52 +89,167 @@ class MetricsCollector:
         monitoring_url = configuration.get_monitoring_url()
         return f"{monitoring_url}:9091/"
 
+    @staticmethod
+    def from_raw_store(deployment_id, request_name, load_name, allowlist=None, denylist=None,
+                       output_format=OUTPUT_CSV) -> 'MetricsCollector':
+        load_folder = utils.get_load_folder(deployment_id, request_name, load_name)
+        header = RawMetricsStore(load_folder).get_header()
+        return MetricsCollector(deployment_id, request_name, load_name,
+                                datetime.fromtimestamp(header['start']), datetime.fromtimestamp(header['end']),
+                                allowlist, denylist, output_format, offline=True)
+
     def extract_metrics(self):
-        instances_with_ports = self.get_label_values("instance")
+        selector = self.prepare_selection()
+        try:
+            catalog = self.get_series_catalog(selector)
+            metrics = [metric for metric in sorted(catalog) if self.metric_selected(metric)]
+            # the whole catalog is kept, a rebuild with other allow/deny lists still knows every node
+            self.raw_store.write_header(self.start, self.end, selector,
+                                        {metric: sorted(catalog[metric]) for metric in sorted(catalog)},
+                                        self.node_domains)
+            self.write_labeled_metrics(catalog, metrics, selector)
+        finally:
+            self.fetcher.close()
+        return "done"
 
-        instances = list()
-        for instance in instances_with_ports:
-            instances.append(instance.split(":")[0])
-        instances = list(dict.fromkeys(instances))
-        names = self.get_label_values("name")
-        metrics = self.get_label_values("__name__")
+    def rebuild_metrics(self):
+        """Labels and writes the metrics of the load again from its raw store, without Prometheus."""
+        header = self.raw_store.get_header()
+        self.node_domains = header['node_domains']
+        catalog = {metric: set(instances) for metric, instances in header['metrics'].items()}
+        metrics = [metric for metric in header['metrics'] if self.metric_selected(metric)]
+        if os.path.exists(self.metrics_folder):
+            shutil.rmtree(self.metrics_folder)
+        self.write_labeled_metrics(catalog, metrics, header['selector'])
+        return "done"
 
+    def prepare_selection(self):
+        instances = self.get_deployment_instances()
+        self.remote_matchers = [(MATCH_REGEXP, 'job', "|".join(METRIC_JOBS)),
+                                (MATCH_REGEXP, 'instance', instance_regexp(instances))]
+        return series_selector(instances)
+
+    def capture_window(self, selector, catalog, start, end):
+        """Stores the raw responses of one window of the load, extending the catalog with its series."""
+        for metric, instances in self.get_series_catalog(selector, start, end).items():
+            catalog.setdefault(metric, set()).update(instances)
+        metrics = [metric for metric in sorted(catalog) if self.metric_selected(metric)]
+        custom_metric_list = utils.read_json_file('openstack_tools/custom_metrics.json')
+        self.store_responds(RECORD_CUSTOM, list(dict.fromkeys(custom_metric_list.values())), start, end)
+        self.store_responds(RECORD_METRIC, [f'{metric}{selector}' for metric in metrics], start, end)
+        return metrics
+
+    def store_responds(self, kind, queries, start, end):
+        """Fetches the responses into the raw store only, without keeping them in memory."""
+        # responds appends every response to the raw store as it is consumed
+        collections.deque(self.responds(kind, queries, start, end), maxlen=0)
+
+    def write_labeled_metrics(self, catalog, metrics, selector):
+        self.load_anomaly_info()
+        # custom metrics of a node are kept when the allow/deny list drops all its series
+        instances = metric_instances(catalog)
         ensure_folder(self.metrics_folder)
         for instance in instances:
             ensure_folder(self.metrics_folder + instance)
         self.write_custom_metrics(instances)
-        self.write_metrics(names, metrics, instances)
+        self.write_metrics([f'{metric}{selector}' for metric in metrics], instances)
         self.folder_ip_to_name(instances)
-        return "done"
 
-    def folder_ip_to_name(self, instances):
+    def responds(self, kind, queries, start=None, end=None):
+        start = start or self.start
+        end = end or self.end
+        if self.offline:
+            yield from self.raw_store.responds(kind, queries)
+            return
+        if kind == RECORD_METRIC and self.remote_reader:
+            # raw series go through remote read, PromQL expressions still need query_range
+            metrics = [query.split("{")[0] for query in queries]
+            responds = zip(queries, (data for metric, data in
+                                     self.remote_reader.read_all(metrics, self.remote_matchers, start, end)))
+        else:
+            responds = self.fetcher.fetch_all(queries, start, end)
+        for query, data in responds:
+            process_registry.check_cancelled()
+            self.raw_store.append(kind, query, data)
+            yield query, data
+
+    def get_deployment_instances(self):
         nodes = Node.query.filter(Node.deployment_id == self.deployment_id).all()
+        self.node_domains = {node.ip: node.domain for node in nodes if node.ip}
+        instances = list(self.node_domains)
+        if not instances:
+            instances = [instance.split(":")[0] for instance in self.get_label_values("instance")]
+        return list(dict.fromkeys(instances))
+
+    def get_series_catalog(self, selector, start=None, end=None):
+        """Returns {metric name: set of instances} for the series alive during the load."""
+        start = start or self.start
+        end = end or self.end
+        series = self.fetcher.get("api/v1/series", {'match[]': selector,
+                                                    'start': start.timestamp(),
+                                                    'end': end.timestamp()})
+        catalog = {}
+        for labels in series:
+            catalog.setdefault(labels['__name__'], set()).add(labels['instance'].split(":")[0])
+        return catalog
+
+    def metric_selected(self, metric):
+        if self.allowlist and not any(pattern.match(metric) for pattern in self.allowlist):
+            return False
+        return not any(pattern.match(metric) for pattern in self.denylist)
+
+    def folder_ip_to_name(self, instances):
+        folders = {}
         for instance in instances:
-            for node in nodes:
-                if node.ip == instance:
-                    os.rename(self.metrics_folder + instance,
-                              self.metrics_folder + node.domain)
+            folders[instance] = instance
+            if instance in self.node_domains:
+                os.rename(self.metrics_folder + instance,
+                          self.metrics_folder + self.node_domains[instance])
+                folders[instance] = self.node_domains[instance]
+        self.write_manifest(folders)
+
+    def write_frame(self, dt, instance, file_name):
+        if self.output_format == OUTPUT_PARQUET:
+            metric_columns = [column for column in dt.columns if column not in ['timestamp', 'label', 'anomaly_type']]
+            dt = dt.astype({**{column: 'float32' for column in metric_columns},
+                            'timestamp': 'float64', 'label': 'int8', 'anomaly_type': 'category'})
+            file_name = f'{file_name}.parquet'
+            dt.to_parquet(self.metrics_folder + instance + '/' + file_name, index=False,
+                          compression=PARQUET_COMPRESSION)
+        else:
+            file_name = f'{file_name}.csv'
+            dt.to_csv(self.metrics_folder + instance + '/' + file_name, index=False)
+        self.manifest.append({'instance': instance,
+                              'file': file_name,
+                              'rows': len(dt.index),
+                              'columns': {column: str(dtype) for column, dtype in dt.dtypes.items()}})
+
+    def write_manifest(self, folders):
+        for entry in self.manifest:
+            entry['file'] = f"{folders.get(entry['instance'], entry['instance'])}/{entry['file']}"
+        manifest = {'format': self.output_format,
+                    'step': METRIC_COLLECTION_STEP,
+                    'start': self.start.timestamp(),
+                    'end': self.end.timestamp(),
+                    'anomaly_type': self.anomaly_type,
+                    'anomaly_start': self.anomaly_start,
+                    'anomaly_end': self.anomaly_end,
+                    'files': self.manifest}
+        with open(self.metrics_folder + FILE_MANIFEST, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
 
 
 
     def request_prometheus_metric(self, metric, name=None, instance=None):
         arguments = list()
         if name:
-            arguments.append(f'name=\"{name}\"')
+            arguments.append(f'name="{name}"')
         if instance:
-            arguments.append(f'instance=~\"{instance}.*\"')
-        argument_string = ""
-        for argument in arguments:
-            ###TODO check if this is ever called
-            argument_string += argument + ','
-        ###TODO
-        request_url = f"http://{self.prometheus_url}/api/v1/query_range?query={metric}" \
-                      f"&start={self.start.timestamp()}&" \
-                      f"end={self.end.timestamp()}&" \
-                      f"step={METRIC_COLLECTION_STEP}&" \
-                      f"{{{argument_string}}}"
-        response = requests.get(request_url)
-        return response.json()['data']['result']
+            arguments.append(f'instance=~"{instance}.*"')
+        query = metric
+        if arguments:
+            query = f'{metric}{{{",".join(arguments)}}}'
+        return self.fetcher.query_range(query, self.start, self.end)['result']
 
     def fault_injection_used(self):
         if not self.rally_report_json:
@@ -110,14 +260,11 @@ class MetricsCollector:
             fault_injection_in_config = 'fault_injection' in hooks[0]['config']['action']
         return fault_injection_in_config
 
-    def write_metrics(self, names, metrics, instances):
-        dt_list = {}
-        for instance in instances:
-            dt_list[METRIC_NO_NAME, instance] = pd.DataFrame()
-            for name in names:
-                dt_list[name, instance] = pd.DataFrame()
-        for metric in metrics:
-            respond = self.request_prometheus_metric(metric)
+    def write_metrics(self, metrics, instances):
+        builder = MetricFrameBuilder()
+        for query, data in self.responds(RECORD_METRIC, metrics):
+            metric = query.split("{")[0]
+            respond = data['result']
             if respond:
                 no_name_metrics = list()
                 named_metrics = list()
@@ -125,52 +272,55 @@ class MetricsCollector:
                     if not 'job' in submetric['metric'].keys():
                         continue
                     else:
-                        if not submetric['metric']['job'] in ['cadvisor', 'node']:
+                        if not submetric['metric']['job'] in METRIC_JOBS:
                             continue
                     clear_port(submetric['metric'])
+                    if submetric['metric']['instance'] not in instances:
+                        continue
                     if 'name' in submetric['metric'].keys():
                         named_metrics.append(submetric)
                     else:
                         no_name_metrics.append(submetric)
                 if named_metrics:
-                    self.write_named_metrics(named_metrics, names, metric, instances, dt_list)
+                    self.write_named_metrics(named_metrics, metric, instances, builder)
                 if no_name_metrics:
-                    self.write_no_named_metrics(no_name_metrics, names, metric, instances, dt_list)
-        ##
-        ##
-        ##
-        for key, dt in dt_list.items():
+                    self.write_no_named_metrics(no_name_metrics, metric, instances, builder)
+        for key in builder.keys():
+            dt = builder.build(key)
             if dt.empty: continue
-            dt.insert(loc=1, column='label', value=0)
-            dt.insert(loc=2, column='anomaly_type', value='-')
-            dt.loc[(self.anomaly_start < dt['timestamp']) & (dt['timestamp'] < self.anomaly_end), 'label'] = 1
-            dt.loc[(self.anomaly_start < dt['timestamp']) & (dt['timestamp'] < self.anomaly_end), 'anomaly_type'] = self.anomaly_type
-            dt.to_csv(self.metrics_folder + '/' + key[1] + '/' + key[0] + '.csv', index=False)
+            self.label_frame(dt)
+            self.write_frame(dt, key[1], key[0])
 
     def write_custom_metrics(self, instances):
         custom_metric_list = utils.read_json_file('openstack_tools/custom_metrics.json')
-        dt_list = {}
+        builder = MetricFrameBuilder()
+        metric_names = {}
+        for metric_name, expression in custom_metric_list.items():
+            metric_names.setdefault(expression, list()).append(metric_name)
+        found = set()
+        for expression, data in self.responds(RECORD_CUSTOM, metric_names):
+            found.add(expression)
+            for metric_name in metric_names[expression]:
+                self.parse_prometheus_metric(builder, data['result'], metric_name)
+        for expression in metric_names:
+            if expression not in found:
+                logging.warning(f'Custom metric {expression} is not available for {self.load_folder}')
         for instance in instances:
-            dt_list[instance] = pd.DataFrame()
-        for metric_name in custom_metric_list:
-            try:
-                if (metric_name == 'node_avg_memory'):
-                    print('alarm')
-                respond = self.request_prometheus_metric(custom_metric_list[metric_name])
-            except KeyError as e:
-                print('error occured at ' + custom_metric_list[metric_name])
-                raise(e)
-            self.parse_prometheus_metric(dt_list, respond, metric_name)
-        for instance in instances:
-            dt = dt_list[instance]
-            dt.insert(loc=1, column='label', value=0)
-            dt.insert(loc=2, column='anomaly_type', value='-')
-            dt.loc[(self.anomaly_start < dt['timestamp']) & (dt['timestamp'] < self.anomaly_end), 'label'] = 1
-            dt.loc[(self.anomaly_start < dt['timestamp']) & (
-                        dt['timestamp'] < self.anomaly_end), 'anomaly_type'] = self.anomaly_type
-            dt.to_csv(self.metrics_folder + '/' + instance + '/' + 'custom_metrics.csv', index=False)
-
-    def write_named_metrics(self, named_metrics, names, metric, instances, dt_list):
+            dt = builder.build(instance)
+            if dt.empty: continue
+            self.label_frame(dt)
+            self.write_frame(dt, instance, 'custom_metrics')
+
+    def label_frame(self, dt):
+        dt.insert(loc=1, column='label', value=0)
+        dt.insert(loc=2, column='anomaly_type', value='-')
+        if self.anomaly_start is None:
+            return
+        anomaly_rows = (self.anomaly_start < dt['timestamp']) & (dt['timestamp'] < self.anomaly_end)
+        dt.loc[anomaly_rows, 'label'] = 1
+        dt.loc[anomaly_rows, 'anomaly_type'] = self.anomaly_type
+
+    def write_named_metrics(self, named_metrics, metric, instances, builder):
         metrics_sorted = {}
         for instance in instances:
             metrics_sorted[instance] = {}
@@ -184,7 +334,6 @@ class MetricsCollector:
             metrics_sorted[meta_info['instance']][meta_info['name']].append(metric_item)
         for instance in metrics_sorted:
             for name in metrics_sorted[instance]:
-                dt = dt_list[name, instance]
                 ensure_folder(self.metrics_folder + instance + "/")
                 metric_group = metrics_sorted[instance][name]
                 different_columns = set()
@@ -205,19 +354,9 @@ class MetricsCollector:
                         if not label in different_columns:
                             continue
                         title = f'{title}_{submetric["metric"][label]}'
-                    df_metric = pd.DataFrame(submetric["values"])
-                    df_metric.columns = ['timestamp', title]
-                    df_metric.set_index('timestamp')
-                    if dt_list[name, instance].empty:
-                        dt_list[name, instance] = dt_list[name, instance].append(df_metric)
-                    else:
-                        if len(df_metric.index) == len(dt_list[name, instance].index):
-                            dt_list[name, instance][title] = df_metric[df_metric.columns[1]]
-                        else:
-                            dt_list[name, instance] = pd.merge(dt_list[name, instance], df_metric,
-                                                               on='timestamp', how="outer")
+                    builder.add((name, instance), title, series_values(submetric))
 
-    def write_no_named_metrics(self, no_name_metrics, names, metric, instances, dt_list):
+    def write_no_named_metrics(self, no_name_metrics, metric, instances, builder):
         metrics_sorted = {}
         for instance in instances:
             metrics_sorted[instance] = list()
@@ -244,8 +383,6 @@ class MetricsCollector:
                         if submetric['metric'][key] != first_instance[0]['metric'][key]:
                             different_columns.add(key)
         for instance in metrics_sorted:
-            dt = dt_list[METRIC_NO_NAME, instance]
-            title = metric
             for submetric in metrics_sorted[instance]:
                 title = metric
                 for label in submetric['metric']:
@@ -254,23 +391,10 @@ class MetricsCollector:
                     if not label in different_columns:
                         continue
                     title = f'{title}_{submetric["metric"][label]}'
-                df_metric = pd.DataFrame(submetric["values"])
-                df_metric.columns = ['timestamp', title]
-                df_metric.set_index('timestamp')
-                if (dt_list[METRIC_NO_NAME, instance].empty):
-                    dt_list[METRIC_NO_NAME, instance] = dt_list[METRIC_NO_NAME, instance].append(df_metric)
-                else:
-                    if (len(df_metric.index) == len(dt_list[METRIC_NO_NAME, instance].index)):
-                        dt_list[METRIC_NO_NAME, instance][title] = df_metric[df_metric.columns[1]]
-                    else:
-                        dt_list[METRIC_NO_NAME, instance] = pd.merge(dt_list[METRIC_NO_NAME, instance], df_metric,
-                                                                     on='timestamp', how="outer")
+                builder.add((METRIC_NO_NAME, instance), title, series_values(submetric))
 
     def get_label_values(self, label):
-        label_values_url = f"http://{self.prometheus_url}api/v1/label/{label}/values"
-        response = requests.get(label_values_url)
-        values = response.json()['data']
-        return values
+        return self.fetcher.get(f"api/v1/label/{label}/values")
 
     def extract_metrics_without_labels(self):
         from openstack_tools import rally_manager
@@ -286,12 +410,14 @@ class MetricsCollector:
         ensure_folder(metrics_folder)
         for instance in instances:
             ensure_folder(metrics_folder + instance)
-        self.write_metrics_without_labels(names, metrics, instances)
-        pass
+        try:
+            self.write_metrics_without_labels(names, metrics, instances)
+        finally:
+            self.fetcher.close()
 
     def write_metrics_without_labels(self, names, metrics, instances):
-        for metric in metrics:
-            respond = self.request_prometheus_metric(metric)
+        for metric, data in self.fetcher.fetch_all(metrics, self.start, self.end):
+            respond = data['result']
             if respond:
                 no_name_metrics = list()
                 named_metrics = list()
@@ -373,7 +499,7 @@ class MetricsCollector:
                     for line in named_metrics[0]["values"]:
                         writer.writerow(line)
 
-    def parse_prometheus_metric(self, dt_list, respond, metric_name):
+    def parse_prometheus_metric(self, builder, respond, metric_name):
         for instance_respond in respond:
             metric_info = instance_respond['metric']
             metric_values = instance_respond['values']
@@ -387,17 +513,25 @@ class MetricsCollector:
             for column in unique_colums:
                 if metric_info[column] not in metric_name:
                     submetric_name = submetric_name + '_' + metric_info[column]
-            dt_instance = dt_list[instance]
+            builder.add(instance, submetric_name, metric_values)
+
+def parse_metric_patterns(patterns):
+    """Compiles a comma separated list of metric name regular expressions."""
+    if not patterns:
+        return []
+    return [re.compile(pattern.strip()) for pattern in patterns.split(",") if pattern.strip()]
+
+
+def instance_regexp(instances):
+    """Regular expression matching the given instances with any port."""
+    return f'({"|".join(re.escape(instance) for instance in instances)})(:.*)?'
+
 
-            dt_values = pd.DataFrame(metric_values)
-            dt_values.columns = ['timestamp', submetric_name]
-            dt_values.set_index('timestamp')
+def series_selector(instances):
+    """PromQL selector limiting series to the collected jobs and the given instances."""
+    escaped_instances = instance_regexp(instances).replace("\\", "\\\\")
+    return f'{{job=~"{"|".join(METRIC_JOBS)}",instance=~"{escaped_instances}"}}'
 
-            if dt_instance.empty:
-                dt_list[instance] = dt_values
-            else:
-                dt_list[instance] = pd.merge(dt_list[instance], dt_values,
-                                             on='timestamp', how="outer")
 
 def ensure_folder(folder):
     if not os.path.exists(folder):
@@ -0,0 +1,68 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import utils
+from openstack_tools.metrics_collector import MetricsCollector, METRIC_COLLECTION_STEP, SOURCE_QUERY_RANGE
+
+STREAM_INTERVAL = 60
+# samples younger than this may not be scraped yet, they are left for the next window
+STREAM_LAG = 30
+
+
+class MetricsStreamer:
+    """Captures the raw metrics of a load into its raw store while the load runs.
+
+    Every `interval` seconds the window since the previous capture is pulled
+    from Prometheus. When the load ends `stop` fetches the remaining window and
+    closes the store, so the labeled metrics can be built with
+    MetricsCollector.from_raw_store right away.
+    """
+
+    def __init__(self, deployment_id, request_name, load_name, start, allowlist=None, denylist=None,
+                 metrics_source=SOURCE_QUERY_RANGE, interval=STREAM_INTERVAL):
+        self.start = start
+        self.interval = interval
+        self.collector = MetricsCollector(deployment_id, request_name, load_name, start, start,
+                                          allowlist, denylist, metrics_source=metrics_source)
+        utils.ensure_folder(self.collector.load_folder)
+        self.selector = self.collector.prepare_selection()
+        self.catalog = {}
+        self.metrics = list()
+        self.captured_until = start
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__stream__, args=[], daemon=True)
+
+    def start_streaming(self):
+        self.collector.raw_store.write_header(self.start, self.start, self.selector, {},
+                                              self.collector.node_domains)
+        self.thread.start()
+
+    def stop(self, end):
+        self.stopped.set()
+        self.thread.join()
+        try:
+            self.capture(end)
+            self.collector.raw_store.write_header(self.start, end, self.selector,
+                                                  {metric: sorted(self.catalog[metric]) for metric in sorted(self.catalog)},
+                                                  self.collector.node_domains, append=True)
+        finally:
+            self.collector.fetcher.close()
+
+    def __stream__(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.capture(self.last_grid_point(datetime.now() - timedelta(seconds=STREAM_LAG)))
+            except Exception as e:
+                # the window stays uncaptured and is retried with the next one
+                logging.error(f'Streaming metrics of {self.collector.load_folder} failed: {e}')
+
+    def last_grid_point(self, time):
+        steps = int((time - self.start).total_seconds() // METRIC_COLLECTION_STEP)
+        return self.start + timedelta(seconds=steps * METRIC_COLLECTION_STEP)
+
+    def capture(self, end):
+        if end < self.captured_until:
+            return
+        self.metrics = self.collector.capture_window(self.selector, self.catalog, self.captured_until, end)
+        self.captured_until = self.last_grid_point(end) + timedelta(seconds=METRIC_COLLECTION_STEP)
@@ -0,0 +1,43 @@
+import logging
+import threading
+
+import openstack
+
+from openstack_tools import openstack_credentials
+
+CONNECTIONS_DICT = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+
+def get_connection(deployment_id):
+    """Returns the shared SDK connection of the deployment.
+
+    The connection keeps its Keystone token and service catalog between calls and
+    renews the token itself when it expires. It is replaced when the credentials
+    of the deployment change, and dropped with `evict` when the cloud goes away.
+    """
+    config = openstack_credentials.get_connect_config(deployment_id)
+    with CONNECTIONS_LOCK:
+        cached = CONNECTIONS_DICT.get(deployment_id)
+        if cached and cached['config'] == config:
+            return cached['connection']
+        if cached:
+            close_connection(cached['connection'])
+        connection = openstack.connect(**config)
+        CONNECTIONS_DICT[deployment_id] = {'config': config, 'connection': connection}
+        return connection
+
+
+def evict(deployment_id):
+    with CONNECTIONS_LOCK:
+        cached = CONNECTIONS_DICT.pop(deployment_id, None)
+    if cached:
+        close_connection(cached['connection'])
+    openstack_credentials.evict_credentials(deployment_id)
+
+
+def close_connection(connection):
+    try:
+        connection.close()
+    except Exception as e:
+        logging.warning(f'Closing OpenStack connection failed: {e}')
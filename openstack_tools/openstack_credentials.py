@@ -0,0 +1,84 @@
+import os
+import threading
+
+from utils import get_deployment_folder
+
+FILE_ADMIN_OPENRC = "admin-openrc.sh"
+FILE_PASSWORDS = "passwords.yml"
+ENV_RALLY_OSPROFILER_KEY = "OSPROFILER_HMAC_KEY"
+PASSWORD_OSPROFILER = "osprofiler_secret"
+
+CREDENTIALS_DICT = {}
+CREDENTIALS_LOCK = threading.Lock()
+
+
+def get_credentials(deployment_id):
+    """Returns the OS_* variables and the osprofiler key of the deployment.
+
+    The files are parsed again only when one of them changed on disk.
+    """
+    deploy_folder = get_deployment_folder(deployment_id)
+    openrc_path = deploy_folder + FILE_ADMIN_OPENRC
+    passwords_path = deploy_folder + FILE_PASSWORDS
+    mtimes = (os.path.getmtime(openrc_path),
+              os.path.getmtime(passwords_path) if os.path.exists(passwords_path) else None)
+    with CREDENTIALS_LOCK:
+        cached = CREDENTIALS_DICT.get(deployment_id)
+        if cached and cached['mtimes'] == mtimes:
+            return dict(cached['credentials'])
+        credentials = parse_openrc(openrc_path)
+        if mtimes[1] is not None:
+            osprofiler_key = parse_password(passwords_path, PASSWORD_OSPROFILER)
+            if osprofiler_key is not None:
+                credentials[ENV_RALLY_OSPROFILER_KEY] = osprofiler_key
+        CREDENTIALS_DICT[deployment_id] = {'mtimes': mtimes, 'credentials': credentials}
+        return dict(credentials)
+
+
+def get_openstack_env(deployment_id):
+    """Environment for subprocesses working on the deployment, the process environment is left as is."""
+    env = os.environ.copy()
+    env.update(get_credentials(deployment_id))
+    return env
+
+
+def get_connect_config(deployment_id):
+    """Keyword arguments of openstack.connect for the deployment, independent of the process environment."""
+    config = {'load_envvars': False, 'load_yaml_config': False}
+    for key, value in get_credentials(deployment_id).items():
+        # the same option names openstack.config derives from OS_* variables
+        if key.startswith('OS_'):
+            config[key[3:].lower()] = value
+    return config
+
+
+def parse_openrc(openrc_path):
+    credentials = {}
+    with open(openrc_path) as input_file:
+        for line in input_file:
+            line = line.strip()
+            if not line.startswith('export ') or '=' not in line:
+                continue
+            key, value = line[len('export '):].split('=', 1)
+            credentials[key.strip()] = unquote(value.strip())
+    return credentials
+
+
+def parse_password(passwords_path, name):
+    with open(passwords_path) as input_file:
+        for line in input_file:
+            key, separator, value = line.partition(':')
+            if separator and key.strip() == name:
+                return unquote(value.strip())
+    return None
+
+
+def unquote(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+
+def evict_credentials(deployment_id):
+    with CREDENTIALS_LOCK:
+        CREDENTIALS_DICT.pop(deployment_id, None)
@@ -13,9 +13,11 @@ from keystoneauth1.exceptions import ConnectFailure
 from requests.structures import CaseInsensitiveDict
 
 import utils
+from cloud_components import process_registry
 from app import db
 from models.deployment import Deployment
-from openstack_tools import rally_manager
+from openstack_tools import openstack_connections
+from openstack_tools.openstack_credentials import get_credentials
 
 STR_CONTROL_IDS = "[control_ids]"
 STR_MONITORING_IDS = "[monitoring_ids]"
@@ -61,7 +63,7 @@ def prepare_config_files(deploy_id):
             to_print = to_print.replace(STR_CONFIG_DIR, f'{os.getcwd()}/custom_config')
             print(to_print, end='')
     shutil.copyfile(f"{DEPLOYER_FILES_FOLDER}/passwords.yml", f"{deploy_folder}passwords.yml")
-    subprocess.run(["kolla-genpwd", "-p", f"{deploy_folder}passwords.yml"])
+    process_registry.run(["kolla-genpwd", "-p", f"{deploy_folder}passwords.yml"])
     shutil.copyfile(f"{DEPLOYER_FILES_FOLDER}/{FILE_BOOTSTRAP}", f"{deploy_folder}{FILE_BOOTSTRAP}")
     shutil.copyfile(f"{DEPLOYER_FILES_FOLDER}/{FILE_ANSIBLE_CFG}", f"{deploy_folder}{FILE_ANSIBLE_CFG}")
 
@@ -78,7 +80,7 @@ def bootstrap_deployment(deploy_id):
                              "--inventory", f"{deploy_folder}{FILE_MULTINODE}", '-vvvv',
                              f"{deploy_folder}{FILE_BOOTSTRAP}"]
     try:
-        subprocess.run(bootstrap_ansible_cmd, stdout=file_log)
+        process_registry.run(bootstrap_ansible_cmd, stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Pre-bootstrapping failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
@@ -110,7 +112,7 @@ def deploy_config(config_id):
                              "--inventory", f"{deploy_folder}{FILE_MULTINODE}",
                              f"{deploy_folder}{FILE_BOOTSTRAP}"]
     try:
-        subprocess.run(bootstrap_ansible_cmd, stdout=file_log)
+        process_registry.run(bootstrap_ansible_cmd, stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Pre-bootstrapping failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
@@ -126,7 +128,7 @@ def deploy_config(config_id):
                               ,"-vvvv"]
 
     try:
-        subprocess.run(kolla_ansible_cmd_base + ["bootstrap-servers"], stdout=file_log)
+        process_registry.run(kolla_ansible_cmd_base + ["bootstrap-servers"], stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Bootstrapping servers failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
@@ -134,13 +136,13 @@ def deploy_config(config_id):
     # TODO when prechecks fail abord deployment and generate report
     # subprocess.run(kolla_ansible_cmd_base + ["prechecks"], stdout=file_log)
     try:
-        subprocess.run(kolla_ansible_cmd_base + ["deploy"], stdout=file_log)
+        process_registry.run(kolla_ansible_cmd_base + ["deploy"], stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Kolla deployment failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
 
     try:
-        subprocess.run(["kolla-ansible",
+        process_registry.run(["kolla-ansible",
                         "--passwords", f"{deploy_folder}{FILE_PASSWORDS}",
                         "--configdir", f"{os.getcwd()}/{deploy_folder}",
                         "--inventory", f"{deploy_folder}{FILE_MULTINODE}"]
@@ -148,7 +150,7 @@ def deploy_config(config_id):
     except subprocess.CalledProcessError as e:
         logging.error("Kolla post-deployment script failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
-    subprocess.run(["sudo", "chmod", "a+r", f"{deploy_folder}/admin-openrc.sh"])
+    process_registry.run(["sudo", "chmod", "a+r", f"{deploy_folder}/admin-openrc.sh"])
     deploy.deploy_end = str(datetime.datetime.now())
     deploy.state = deploy.STATE_DEPLOYED
     db.session.commit()
@@ -156,8 +158,7 @@ def deploy_config(config_id):
     prepare_elasticsearch(config_id)
 
 def prepare_openstack(deploy_id):
-    rally_manager.get_openstack_env(deploy_id)
-    connection = openstack.connect()
+    connection = openstack_connections.get_connection(deploy_id)
     if not connection.get_flavor('m1.tiny'):
         connection.create_flavor('m1.tiny', 512, 1, 1)
     if not connection.get_flavor('m1.small'):
@@ -170,13 +171,11 @@ def prepare_openstack(deploy_id):
         connection.create_image('corrupted_image',
                             './cirros-0.3.4-x86_64-disk_corrupted.img',
                             container_format="bare", disk_format="qcow2", visibility="public" )
-    connection.close()
     return "openstack prepared"
 
 def clear_openstack(config_id):
-    rally_manager.get_openstack_env(config_id)
     try:
-        connection = openstack.connect()
+        connection = openstack_connections.get_connection(config_id)
     except ConnectionRefusedError as e:
         return
     try:
@@ -217,17 +216,18 @@ def destroy_config(config_id):
                               "--configdir", f"{deploy_folder}",
                               "--inventory", f"{deploy_folder}{FILE_MULTINODE}"]
     try:
-        subprocess.run(kolla_ansible_cmd_base + ["stop", "--yes-i-really-really-mean-it"],
+        process_registry.run(kolla_ansible_cmd_base + ["stop", "--yes-i-really-really-mean-it"],
                    stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Kolla post-deployment script failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
     try:
-        subprocess.run(kolla_ansible_cmd_base + ["destroy", "--yes-i-really-really-mean-it"],
+        process_registry.run(kolla_ansible_cmd_base + ["destroy", "--yes-i-really-really-mean-it"],
                    stdout=file_log)
     except subprocess.CalledProcessError as e:
         logging.error("Kolla post-deployment script failed. Check {} for additional information. Error code: {}. "
                       "Error message {}", file_log, e.returncode, e.output)
+    openstack_connections.evict(config_id)
     config = Deployment.load(config_id)
     config.state = config.STATE_DESTROYED
 
@@ -243,21 +243,14 @@ def delete_deployment(deploy_id):
         deployment.nodes.remove(node)
     Deployment.query.filter(Deployment.id == deploy_id).delete()
     db.session.commit()
+    openstack_connections.evict(deploy_id)
     if os.path.isdir(f"deploy_list/deploy{deploy_id}/"):
         shutil.rmtree(f"deploy_list/deploy{deploy_id}/")
 
 @staticmethod
 def parse_admin_openrc_to_json(config_id):
     deploy_folder = f"deploy_list/deploy{config_id}/"
-    input_dict = {}
-    with open(f'{deploy_folder}admin-openrc.sh') as inpute_file:
-        next(inpute_file)
-        next(inpute_file)
-        for line in inpute_file:
-            line = line.rstrip('\n')
-            line = line.lstrip('export ')
-            key, value = line.split('=')
-            input_dict[key] = value
+    input_dict = get_credentials(config_id)
     admin_info = {'openstack':
                       {"auth_url": input_dict['OS_AUTH_URL'],
                        "region_name": input_dict["OS_REGION_NAME"],
@@ -280,26 +273,34 @@ def node_restart(deploy_id, kwargs):
     deploy = Deployment.load(deploy_id)
     deploy_folder = f"deploy_list/deploy{deploy.id}/"
     file_log = open(f"{deploy_folder}{node}_log", "a")
-    rally_manager.get_openstack_env(deploy_id)
-    connection = openstack.connect()
+    connection = openstack_connections.get_connection(deploy_id)
     print(f"Disabling {node}")
     file_log.write("Starting_Maintenance\n")
     file_log.flush()
+    set_compute_service(connection, node, False, file_log)
     try:
-        subprocess.run(["openstack", "compute", "service", "set", "--disable", node, "nova-compute"],
-        stdout=file_log)
-    except subprocess.CalledProcessError as e:
-        logging.error("Kolla post-deployment script failed. Check {} for additional information. Error code: {}. "
-                      "Error message {}", file_log, e.returncode, e.output)
-    waiting_time = 15
-    while len(connection.list_servers(filters={"host": node})) > 0:
-        sleep(waiting_time)
-        waiting_time = waiting_time * 2 if waiting_time < 60 else waiting_time
-    file_log.write("Maintenance done!\n")
-    file_log.flush()
+        waiting_time = 15
+        while len(connection.list_servers(filters={"host": node})) > 0:
+            process_registry.check_cancelled()
+            sleep(waiting_time)
+            waiting_time = waiting_time * 2 if waiting_time < 60 else waiting_time
+        file_log.write("Maintenance done!\n")
+        file_log.flush()
+    finally:
+        # a cancelled restart must not leave the node disabled
+        set_compute_service(connection, node, True, file_log)
+
+
+def set_compute_service(connection, node, enabled, file_log):
+    # same as "openstack compute service set --enable/--disable <node> nova-compute", on the pooled connection
     try:
-        subprocess.run(["openstack", "compute", "service", "set", "--enable", node, "nova-compute"],
-        stdout=file_log)
-    except subprocess.CalledProcessError as e:
-        logging.error("Kolla post-deployment script failed. Check {} for additional information. Error code: {}. "
-                      "Error message {}", file_log, e.returncode, e.output)
+        for service in connection.compute.services(host=node, binary="nova-compute"):
+            if enabled:
+                connection.compute.enable_service(service, service.host, service.binary)
+            else:
+                connection.compute.disable_service(service, service.host, service.binary)
+            file_log.write(f"nova-compute on {node} {'enabled' if enabled else 'disabled'}\n")
+    except openstack.exceptions.SDKException as e:
+        logging.error(f"Setting nova-compute on {node} to enabled={enabled} failed: {e}")
+        file_log.write(f"{e}\n")
+    file_log.flush()
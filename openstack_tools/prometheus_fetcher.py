@@ -0,0 +1,165 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FETCH_WORKERS = 16
+FETCH_RETRIES = 4
+FETCH_BACKOFF = 0.5
+FETCH_TIMEOUT = 60
+# Prometheus refuses ranges above 11000 points per series, smaller chunks also bound the response size
+MAX_POINTS_PER_CHUNK = 1000
+# responses retried besides 5xx, other 4xx responses are raised at once
+RETRY_STATUS_CODES = [429]
+
+
+class PrometheusFetcher:
+    """Runs query_range calls concurrently over one keep-alive session.
+
+    Long windows are split into chunks of at most `max_points` steps, which are
+    fetched in parallel and stitched back into one series per label set. At most
+    `workers` requests are in flight at any time. Connection errors, timeouts,
+    5xx and 429 responses are retried with exponential backoff before the error
+    is raised to the caller, other errors such as a 400 for a bad expression
+    are raised at once.
+    """
+
+    def __init__(self, prometheus_url, step, workers=FETCH_WORKERS, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF,
+                 max_points=MAX_POINTS_PER_CHUNK):
+        self.prometheus_url = prometheus_url
+        self.step = step
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_points = max_points
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def get(self, path, params=None):
+        return self.request("GET", path, lambda response: response.json()['data'], params=params)
+
+    def post(self, path, data, headers):
+        return self.request("POST", path, lambda response: response.content, data=data, headers=headers)
+
+    def request(self, method, path, parse, **kwargs):
+        url = f"http://{self.prometheus_url}{path}"
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, timeout=FETCH_TIMEOUT, **kwargs)
+                response.raise_for_status()
+                return parse(response)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if not is_transient(e):
+                    logging.error(f'Prometheus request {path} {kwargs.get("params")} failed: {e}')
+                    raise
+                if attempt >= self.retries:
+                    logging.error(f'Prometheus request {path} {kwargs.get("params")} failed '
+                                  f'after {attempt + 1} attempts: {e}')
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt = attempt + 1
+
+    def query_range(self, query, start, end):
+        return stitch_chunks([future.result() for future in self.submit_chunks(query, start, end)])
+
+    def fetch_all(self, queries, start, end):
+        """Yields (query, result) pairs in the order of `queries`.
+
+        Only a bounded window of chunks is submitted ahead of the consumer, so
+        the responses held in memory stay proportional to the worker count.
+        """
+        queries = iter(queries)
+        pending = deque()
+        pending_chunks = 0
+        while True:
+            while pending_chunks < self.workers * 2:
+                query = next(queries, None)
+                if query is None:
+                    break
+                futures = self.submit_chunks(query, start, end)
+                pending.append((query, futures))
+                pending_chunks = pending_chunks + len(futures)
+            if not pending:
+                return
+            query, futures = pending.popleft()
+            pending_chunks = pending_chunks - len(futures)
+            yield query, stitch_chunks([future.result() for future in futures])
+
+    def submit_chunks(self, query, start, end):
+        return [self.executor.submit(self.query_range_chunk, query, chunk_start, chunk_end)
+                for chunk_start, chunk_end in split_window(start, end, self.step, self.max_points)]
+
+    def query_range_chunk(self, query, start, end):
+        return self.get("api/v1/query_range", {'query': query,
+                                               'start': start.timestamp(),
+                                               'end': end.timestamp(),
+                                               'step': self.step})
+
+
+def is_transient(error):
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status >= 500 or status in RETRY_STATUS_CODES)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def split_window(start, end, step, max_points):
+    """Splits [start, end] into consecutive windows of at most max_points evaluation steps.
+
+    Every window starts on the step grid of the whole range, so the stitched
+    chunks have exactly the timestamps a single query would have returned.
+    """
+    chunk_length = timedelta(seconds=step * (max_points - 1))
+    chunks = list()
+    chunk_start = start
+    while True:
+        chunk_end = min(chunk_start + chunk_length, end)
+        chunks.append((chunk_start, chunk_end))
+        if chunk_end >= end:
+            return chunks
+        chunk_start = chunk_end + timedelta(seconds=step)
+        if chunk_start > end:
+            return chunks
+
+
+def stitch_chunks(chunks):
+    """Joins query_range results of consecutive windows into one series per label set."""
+    if len(chunks) == 1:
+        return chunks[0]
+    series = {}
+    for chunk in chunks:
+        for submetric in chunk['result']:
+            key = frozenset(submetric['metric'].items())
+            stitched = series.get(key)
+            if 'samples' in submetric:
+                # remote read series keep their samples as separate timestamp and value arrays
+                if stitched is None:
+                    series[key] = {'metric': submetric['metric'],
+                                   'timestamps': list(submetric['timestamps']),
+                                   'samples': list(submetric['samples'])}
+                    continue
+                for timestamp, value in zip(submetric['timestamps'], submetric['samples']):
+                    if not stitched['timestamps'] or timestamp > stitched['timestamps'][-1]:
+                        stitched['timestamps'].append(timestamp)
+                        stitched['samples'].append(value)
+                continue
+            if stitched is None:
+                series[key] = {'metric': submetric['metric'], 'values': list(submetric['values'])}
+                continue
+            last_timestamp = stitched['values'][-1][0] if stitched['values'] else None
+            for value in submetric['values']:
+                if last_timestamp is None or value[0] > last_timestamp:
+                    stitched['values'].append(value)
+    return {'resultType': chunks[0]['resultType'], 'result': list(series.values())}
@@ -0,0 +1,258 @@
+import struct
+from collections import deque
+
+import numpy as np
+import snappy
+
+REMOTE_READ_PATH = "api/v1/read"
+REMOTE_READ_HEADERS = {'Content-Encoding': 'snappy',
+                       'Content-Type': 'application/x-protobuf',
+                       'X-Prometheus-Remote-Read-Version': '0.1.0'}
+# metric names sent in one ReadRequest
+REMOTE_READ_BATCH = 10
+# Prometheus looks back this far for the latest sample of a query_range evaluation step
+LOOKBACK_DELTA = 300
+# bit pattern Prometheus uses to mark a series as stale
+STALE_NAN = 0x7ff0000000000002
+
+MATCH_EQUAL = 0
+MATCH_REGEXP = 2
+
+# key and length of a Sample field, then the value double and a 6 byte varint timestamp in ms,
+# the encoding of every sample with a non zero value between 1971 and 2109
+SAMPLE_SIZE = 18
+SAMPLE_KEY = 0x12
+SAMPLE_MASK = np.array([0xff, 0xff, 0xff] + [0] * 8 + [0xff] + [0x80] * 6, dtype=np.uint8)
+SAMPLE_PATTERN = np.array([SAMPLE_KEY, 0x10, 0x09] + [0] * 8 + [0x10] + [0x80] * 5 + [0], dtype=np.uint8)
+TIMESTAMP_SHIFTS = np.arange(0, 42, 7, dtype=np.int64)
+# samples checked at once for the regular encoding, doubled while it holds
+SAMPLE_RUN_BLOCK = 64
+
+
+class RemoteReader:
+    """Reads raw series through the Prometheus remote read API.
+
+    Requests and responses are snappy compressed protobuf messages, decoded
+    straight into numpy arrays. Batches of metric names are read in parallel on
+    the fetcher's worker pool and session, and every series is resampled onto the
+    query_range step grid so it lines up with the JSON path.
+    """
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    def read_all(self, metrics, matchers, start, end):
+        """Yields (metric, result) pairs in the order of `metrics`.
+
+        `matchers` is a list of (type, label, value) tuples added to the metric
+        name matcher of every query.
+        """
+        metrics = list(metrics)
+        pending = deque()
+        batches = iter(range(0, len(metrics), REMOTE_READ_BATCH))
+        while True:
+            while len(pending) < self.fetcher.workers * 2:
+                batch_start = next(batches, None)
+                if batch_start is None:
+                    break
+                batch = metrics[batch_start:batch_start + REMOTE_READ_BATCH]
+                pending.append((batch, self.fetcher.executor.submit(self.read_batch, batch, matchers, start, end)))
+            if not pending:
+                return
+            batch, future = pending.popleft()
+            for metric, result in zip(batch, future.result()):
+                yield metric, result
+
+    def read_batch(self, metrics, matchers, start, end):
+        start_ms = int((start.timestamp() - LOOKBACK_DELTA) * 1000)
+        end_ms = int(end.timestamp() * 1000)
+        queries = [encode_query(start_ms, end_ms, [(MATCH_EQUAL, '__name__', metric)] + matchers)
+                   for metric in metrics]
+        request = encode_read_request(queries)
+        response = self.fetcher.post(REMOTE_READ_PATH, snappy.compress(request), REMOTE_READ_HEADERS)
+        grid = step_grid(start.timestamp(), end.timestamp(), self.fetcher.step)
+        results = list()
+        for timeseries in decode_read_response(snappy.uncompress(response)):
+            series = list()
+            for labels, timestamps, values in timeseries:
+                grid_timestamps, grid_values = align_to_grid(grid, timestamps, values)
+                if len(grid_timestamps):
+                    series.append({'metric': labels, 'timestamps': grid_timestamps, 'samples': grid_values})
+            results.append({'resultType': 'matrix', 'result': series})
+        return results
+
+
+def step_grid(start, end, step):
+    return start + step * np.arange(int((end - start) // step) + 1)
+
+
+def align_to_grid(grid, timestamps, values):
+    """Picks the latest sample inside the lookback window for every step, like query_range does."""
+    if not len(timestamps):
+        return grid[:0], values[:0]
+    positions = np.searchsorted(timestamps, grid, side='right') - 1
+    found = positions >= 0
+    positions = np.where(found, positions, 0)
+    stale = values.view(np.uint64) == STALE_NAN
+    found &= (grid - timestamps[positions]) <= LOOKBACK_DELTA
+    found &= ~stale[positions]
+    return grid[found], values[positions[found]]
+
+
+def encode_read_request(queries):
+    return b''.join(encode_field(1, query) for query in queries)
+
+
+def encode_query(start_ms, end_ms, matchers):
+    message = encode_varint_field(1, start_ms) + encode_varint_field(2, end_ms)
+    for matcher_type, name, value in matchers:
+        matcher = encode_varint_field(1, matcher_type) + encode_field(2, name.encode()) + encode_field(3, value.encode())
+        message += encode_field(3, matcher)
+    return message
+
+
+def encode_field(number, payload):
+    return encode_varint((number << 3) | 2) + encode_varint(len(payload)) + payload
+
+
+def encode_varint_field(number, value):
+    # proto3 leaves fields at their default out, as the Go encoder of Prometheus does
+    if not value:
+        return b''
+    return encode_varint(number << 3) + encode_varint(value)
+
+
+def encode_varint(value):
+    value &= (1 << 64) - 1
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def read_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def iter_fields(buffer, position, end):
+    """Yields (field number, wire type, value) of a protobuf message.
+
+    Length delimited values are returned as (start, end) offsets into the buffer.
+    """
+    while position < end:
+        field, wire_type, value, position = read_field(buffer, position)
+        yield field, wire_type, value
+
+
+def read_field(buffer, position):
+    key, position = read_varint(buffer, position)
+    wire_type = key & 7
+    if wire_type == 0:
+        value, position = read_varint(buffer, position)
+    elif wire_type == 1:
+        value = buffer[position:position + 8]
+        position += 8
+    elif wire_type == 2:
+        length, position = read_varint(buffer, position)
+        value = (position, position + length)
+        position += length
+    elif wire_type == 5:
+        value = buffer[position:position + 4]
+        position += 4
+    else:
+        raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+    return key >> 3, wire_type, value, position
+
+
+def decode_read_response(buffer):
+    """Returns one list of (labels, timestamps, values) per query of the ReadRequest."""
+    buffer = memoryview(buffer)
+    array = np.frombuffer(buffer, dtype=np.uint8)
+    results = list()
+    for field, wire_type, (result_start, result_end) in iter_fields(buffer, 0, len(buffer)):
+        if field != 1:
+            continue
+        timeseries = list()
+        for series_field, _, (series_start, series_end) in iter_fields(buffer, result_start, result_end):
+            if series_field == 1:
+                timeseries.append(decode_timeseries(buffer, array, series_start, series_end))
+        results.append(timeseries)
+    return results
+
+
+def decode_timeseries(buffer, array, start, end):
+    """Decodes a TimeSeries, runs of regularly encoded samples are parsed by numpy at once."""
+    labels = {}
+    timestamps = list()
+    values = list()
+    position = start
+    while position < end:
+        if buffer[position] == SAMPLE_KEY:
+            run_timestamps, run_values, position = read_sample_run(array, position, end)
+            if len(run_timestamps):
+                timestamps.append(run_timestamps)
+                values.append(run_values)
+                continue
+        field, _, (field_start, field_end), position = read_field(buffer, position)
+        if field == 1:
+            label = {}
+            for label_field, _, (value_start, value_end) in iter_fields(buffer, field_start, field_end):
+                label[label_field] = bytes(buffer[value_start:value_end]).decode()
+            labels[label.get(1, '')] = label.get(2, '')
+        elif field == 2:
+            timestamp, value = decode_sample(buffer, field_start, field_end)
+            timestamps.append(np.array([timestamp], dtype=np.int64))
+            values.append(np.array([value], dtype=np.float64))
+    if not timestamps:
+        return labels, np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+    return labels, np.concatenate(timestamps) / 1000.0, np.concatenate(values)
+
+
+def read_sample_run(array, position, end):
+    """Parses the regularly encoded Sample fields from `position` on.
+
+    Returns (timestamps in ms, values, position after the run), the run is
+    empty if the field at `position` is encoded otherwise.
+    """
+    runs = list()
+    block = SAMPLE_RUN_BLOCK
+    while True:
+        count = min(block, (end - position) // SAMPLE_SIZE)
+        if not count:
+            break
+        rows = array[position:position + count * SAMPLE_SIZE].reshape(count, SAMPLE_SIZE)
+        regular = np.all((rows & SAMPLE_MASK) == SAMPLE_PATTERN, axis=1)
+        regular_count = count if regular.all() else int(np.argmin(regular))
+        runs.append(rows[:regular_count])
+        position += regular_count * SAMPLE_SIZE
+        if regular_count < count:
+            break
+        block *= 2
+    rows = np.concatenate(runs) if runs else array[:0].reshape(0, SAMPLE_SIZE)
+    values = np.ascontiguousarray(rows[:, 3:11]).view('<f8').ravel()
+    timestamps = ((rows[:, 12:] & 0x7f).astype(np.int64) << TIMESTAMP_SHIFTS).sum(axis=1)
+    return timestamps, values, position
+
+
+def decode_sample(buffer, start, end):
+    value = 0.0
+    timestamp = 0
+    for sample_field, _, sample_value in iter_fields(buffer, start, end):
+        if sample_field == 1:
+            value = struct.unpack('<d', sample_value)[0]
+        elif sample_field == 2:
+            timestamp = sample_value - (1 << 64) if sample_value >= 1 << 63 else sample_value
+    return timestamp, value
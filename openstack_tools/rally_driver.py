@@ -0,0 +1,218 @@
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from cloud_components import process_registry
+
+DRIVER_START_TIMEOUT = 300
+# seconds the CLI is used for a deployment after its worker failed to start
+DRIVER_RETRY_INTERVAL = 600
+# same line "rally task start" prints, kept in rally_log for get_task_name
+RALLY_TASK_LINE = "Task  {}: started"
+
+DRIVERS_DICT = {}
+DRIVERS_LOCK = threading.Lock()
+# deployment_id -> lock held while the worker of the deployment is stopped or started
+DEPLOYMENT_LOCKS_DICT = {}
+# deployment_id -> (config hash, failure time, error) of the last failed worker start
+DRIVER_FAILURES_DICT = {}
+
+
+class RallyDriverUnavailable(Exception):
+    """Rally can not be run in process, the rally CLI has to be used."""
+
+
+class RallyTaskError(Exception):
+    """Rally rejected or failed a task."""
+
+
+class RallyDriver:
+    """Runs Rally through its Python API in one long-lived worker process.
+
+    Rally and its plugins are imported and the database is opened once, when the
+    worker starts. Every call is a message to the worker, so validation, task
+    start and report generation return their results, task ids included,
+    instead of output a CLI run leaves in a log file.
+    """
+
+    def __init__(self, config_file, plugin_paths, env):
+        self.config_hash = file_hash(config_file)
+        self.env = env
+        context = multiprocessing.get_context('spawn')
+        self.connection, worker_connection = context.Pipe()
+        self.lock = threading.Lock()
+        self.process = context.Process(target=serve, daemon=True,
+                                       args=[worker_connection, os.path.abspath(config_file),
+                                             [os.path.abspath(path) for path in plugin_paths], env])
+        self.process.start()
+        worker_connection.close()
+        if not self.connection.poll(DRIVER_START_TIMEOUT):
+            self.stop()
+            raise RallyDriverUnavailable('Rally worker did not start in time')
+        status, result = self.connection.recv()
+        if status != 'ok':
+            self.stop()
+            raise RallyDriverUnavailable(result)
+
+    def call(self, command, **kwargs):
+        with self.lock:
+            if not self.process.is_alive():
+                raise RallyDriverUnavailable('Rally worker exited')
+            try:
+                # cancelling the request kills the worker, the next call starts a new one
+                with process_registry.registered(self.process):
+                    self.connection.send((command, kwargs))
+                    status, result = self.connection.recv()
+            except (EOFError, OSError) as e:
+                raise RallyDriverUnavailable(f'Rally worker exited: {e}')
+        if status != 'ok':
+            raise RallyTaskError(result)
+        return result
+
+    def validate(self, deployment, task_file):
+        return self.call('validate', deployment=deployment, task_file=os.path.abspath(task_file))
+
+    def start(self, deployment, task_file, log_file):
+        """Runs the task from the folder of `task_file` and returns its uuid."""
+        return self.call('start', deployment=deployment, task_file=os.path.abspath(task_file),
+                         log_file=os.path.abspath(log_file))
+
+    def report(self, task_ids, output_type, output_file):
+        return self.call('report', task_ids=task_ids, output_type=output_type,
+                         output_file=os.path.abspath(output_file))
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                with self.lock:
+                    self.connection.send(('stop', {}))
+            except OSError:
+                pass
+            self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+def get_driver(deployment_id, config_file, plugin_paths, env):
+    """Returns the worker of the deployment, restarted when the Rally config or the credentials changed.
+
+    `env` is the OpenStack environment of the deployment the worker runs with.
+    Workers are stopped and started under the lock of their deployment only, a
+    long task of one deployment does not hold up the others.
+    """
+    config_hash = file_hash(config_file)
+    with DRIVERS_LOCK:
+        deployment_lock = DEPLOYMENT_LOCKS_DICT.setdefault(deployment_id, threading.Lock())
+    with deployment_lock:
+        with DRIVERS_LOCK:
+            failure = DRIVER_FAILURES_DICT.get(deployment_id)
+            # a failed start is retried after a while, or at once when the Rally config changed
+            if failure and failure[0] == config_hash and time.monotonic() - failure[1] < DRIVER_RETRY_INTERVAL:
+                raise RallyDriverUnavailable(failure[2])
+            driver = DRIVERS_DICT.get(deployment_id)
+            if driver and driver.process.is_alive() and driver.config_hash == config_hash \
+                    and driver.env == env:
+                return driver
+            DRIVERS_DICT.pop(deployment_id, None)
+        if driver:
+            # waits for a call still running on the stale worker
+            driver.stop()
+        try:
+            driver = RallyDriver(config_file, plugin_paths, env)
+        except RallyDriverUnavailable as e:
+            with DRIVERS_LOCK:
+                DRIVER_FAILURES_DICT[deployment_id] = (config_hash, time.monotonic(), str(e))
+            raise
+        with DRIVERS_LOCK:
+            DRIVER_FAILURES_DICT.pop(deployment_id, None)
+            DRIVERS_DICT[deployment_id] = driver
+        return driver
+
+
+def stop_drivers():
+    with DRIVERS_LOCK:
+        drivers = list(DRIVERS_DICT.values())
+        DRIVERS_DICT.clear()
+    for driver in drivers:
+        driver.stop()
+
+
+atexit.register(stop_drivers)
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as input_file:
+        return hashlib.sha256(input_file.read()).hexdigest()
+
+
+def serve(connection, config_file, plugin_paths, env):
+    # leads its own process group, a cancelled request tears it down with its children
+    os.setsid()
+    # the worker serves a single deployment, its environment can hold the credentials
+    os.environ.update(env)
+    try:
+        from rally import api
+        rally_api = api.API(config_file=config_file, plugin_paths=plugin_paths)
+    except Exception as e:
+        connection.send(('error', f'{type(e).__name__}: {e}'))
+        return
+    connection.send(('ok', None))
+    commands = {'validate': validate_task, 'start': start_task, 'report': export_report}
+    while True:
+        try:
+            command, kwargs = connection.recv()
+        except EOFError:
+            return
+        if command == 'stop':
+            return
+        cwd = os.getcwd()
+        try:
+            connection.send(('ok', commands[command](rally_api, **kwargs)))
+        except Exception as e:
+            connection.send(('error', f'{type(e).__name__}: {e}'))
+        finally:
+            os.chdir(cwd)
+
+
+def load_task(rally_api, task_file):
+    # rendered and parsed the way "rally task validate/start" read the task file
+    import yaml
+    with open(task_file) as input_file:
+        task_template = input_file.read()
+    rendered = rally_api.task.render_template(task_template=task_template,
+                                              template_dir=os.path.dirname(task_file))
+    return yaml.safe_load(rendered)
+
+
+def validate_task(rally_api, deployment, task_file):
+    rally_api.task.validate(deployment=deployment, config=load_task(rally_api, task_file))
+    return True
+
+
+def start_task(rally_api, deployment, task_file, log_file):
+    config = load_task(rally_api, task_file)
+    task = rally_api.task.create(deployment=deployment)
+    handler = logging.FileHandler(log_file)
+    with open(log_file, 'a') as output_file:
+        output_file.write(RALLY_TASK_LINE.format(task['uuid']) + '\n')
+    logging.getLogger().addHandler(handler)
+    os.chdir(os.path.dirname(task_file))
+    try:
+        rally_api.task.start(deployment=deployment, config=config, task=task['uuid'])
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    return task['uuid']
+
+
+def export_report(rally_api, task_ids, output_type, output_file):
+    result = rally_api.task.export(tasks=task_ids, output_type=output_type, output_dest=output_file)
+    for path, content in result.get('files', {}).items():
+        with open(path, 'w') as output:
+            output.write(content)
+    return list(result.get('files', {}))
@@ -1,23 +1,27 @@
 import fileinput
 import json
+import logging
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-import openstack
-
 import utils
+from cloud_components import process_registry
 from utils import *
 from models.deployment import Deployment
+from openstack_tools import log_exporter, openstack_connections, openstack_credentials, validation_cache
+from openstack_tools.experiment_archiver import ExperimentArchiver, get_container_path
+from openstack_tools.rally_driver import get_driver, RallyDriverUnavailable, RallyTaskError
+from openstack_tools.trace_fetcher import TraceFetcher, TRACE_BATCH
 
 FLAVOR_SMALL = 'm1.tiny'
 FLAVOR_DEFAULT = FLAVOR_SMALL
 
-ENV_RALLY_OSPROFILER_KEY = "OSPROFILER_HMAC_KEY"
-
 RALLY_HTML_LINE_TO_REPLACE = "ng-repeat=\'str in data track by $index\'>{{str}}"
 RALLY_HTML_LINE_REQUIRED = "          var template = \"<div style=\'padding:0 0 5px\' ng-repeat=\'str in data track by $index\'><a href=\\\"{{window.location.href.substr(0, window.location.href.indexOf(\'rally_report\'))}}traces/{{str}}\\\">{{str}}</a></div><div style=\'height:10px\'></div>\";\n"
 ANSIBLE_INVENTORY_SEARCHED_LINE = "[controllers]"
@@ -34,9 +38,14 @@ RALLY_OUTPUT_JSON = "rally_report.json"
 
 FILE_RALLY_LOG = "rally_log"
 FILE_RALLY_ERROR = "rally_error"
+FILE_LOADS_SUMMARY = "loads_summary.jsonl"
+FILE_REPORT_STATE = "rally_report_state.json"
 
 TRACES_HTML_FOLDER = "traces_html"
 TRACES_JSON_FOLDER = "traces_json"
+FILE_TRACES_FAILED = "traces_failed.json"
+TRACE_WORKERS = 8
+TRACE_PROGRESS_STEP = 100
 
 CUSTOM_TASK = 'custom_task'
 
@@ -45,6 +54,8 @@ STR_DURATION = "[duration]"
 STR_HOOKS = "[hooks]"
 
 ANOMALY_INJECTION_PATH_DICT = {'value':None}
+TRACE_HTML_TEMPLATE_DICT = {'value': None}
+EXPERIMENT_REPORT_LOCK = threading.Lock()
 
 RALLY_TASK_REGEXP = "Task  .*:"
 
@@ -80,23 +91,7 @@ def get_anomaly_injection_path():
 
 
 def get_openstack_env(config_id):
-    deploy_folder = f"deploy_list/deploy{config_id}/"
-    my_env = os.environ.copy()
-    with open(f'{deploy_folder}admin-openrc.sh') as input_file:
-        for line in input_file:
-            if 'export' not in line:
-                continue
-            line = line.rstrip('\n')
-            line = line.lstrip('export ')
-            key, value = line.split('=')
-            my_env[key] = value
-    with open(f'{deploy_folder}passwords.yml') as input_file:
-        for line in input_file:
-            if "osprofiler_secret" in line:
-                line = line.rstrip('\n')
-                osprofiler_key = line.lstrip('osprofiler_secret: ')
-                my_env[ENV_RALLY_OSPROFILER_KEY] = osprofiler_key
-    os.environ.update(my_env)
+    return openstack_credentials.get_openstack_env(config_id)
 
 
 def create_deployment(config_id):
@@ -105,9 +100,12 @@ def create_deployment(config_id):
         return
     file_log = open(f"{deploy_folder}rally_log", "a+")
     file_log.flush()
-    get_openstack_env(config_id)
-    subprocess.run(["rally", "deployment", "destroy", f"deployment{config_id}"], stdin=subprocess.PIPE,  stdout=file_log)
-    subprocess.run(["rally", "deployment", "create", "--fromenv", f"--name=deployment{config_id}"], stdin=subprocess.PIPE, stdout=file_log)
+    env = get_openstack_env(config_id)
+    validation_cache.clear_validation_cache(config_id)
+    process_registry.run(["rally", "deployment", "destroy", f"deployment{config_id}"], stdin=subprocess.PIPE,  stdout=file_log,
+                   env=env)
+    process_registry.run(["rally", "deployment", "create", "--fromenv", f"--name=deployment{config_id}"], stdin=subprocess.PIPE,
+                   stdout=file_log, env=env)
 
 
 def add_trace_hrefs_to_rally(deploy_id, load_folder):
@@ -127,30 +125,33 @@ def add_trace_hrefs_to_rally(deploy_id, load_folder):
 
 
 def create_image(config_id, conf_env):
-    conn = openstack.connect()
+    conn = openstack_connections.get_connection(config_id)
     image = conn.get_image("TestVM")
     if image:
         return
-    subprocess.run(
+    env = get_openstack_env(config_id)
+    process_registry.run(
         ['openstack', 'flavor', 'create', '--public', FLAVOR_DEFAULT, '--id', 'auto', '--ram', '512', '--disk', '1',
-         '--vcpus', '1'], stdin=subprocess.PIPE)
+         '--vcpus', '1'], stdin=subprocess.PIPE, env=env)
     if not os.path.exists('cirros-0.3.4-x86_64-disk.img'):
-        subprocess.run(['wget', 'http://downloacirros-cloud.net/0.3.4/cirros-0.3.4-x86_64-disk.img'], stdin=subprocess.PIPE)
-    subprocess.run(
+        process_registry.run(['wget', 'http://downloacirros-cloud.net/0.3.4/cirros-0.3.4-x86_64-disk.img'], stdin=subprocess.PIPE)
+    process_registry.run(
         ['openstack', 'image', 'create', 'TestVM', '--file', 'cirros-0.3.4-x86_64-disk.img', '--disk-format', 'qcow2',
-         '--container-format', 'bare', '--public'], stdin=subprocess.PIPE)
+         '--container-format', 'bare', '--public'], stdin=subprocess.PIPE, env=env)
 
 
 def openstack_image_exists(config_id, name):
-    get_openstack_env(config_id)
-    output = subprocess.run(['openstack', 'image', 'list'], capture_output=True, stdin=subprocess.PIPE)
+    output = process_registry.run(['openstack', 'image', 'list'], capture_output=True, stdin=subprocess.PIPE,
+                            env=get_openstack_env(config_id))
     return output
 
 
-def compress_output_data(deployment_id, request_name):
-    experiment_folder = get_experiment_folder(deployment_id, request_name)
-    rally_folder = get_rally_folder(deployment_id)
-    shutil.make_archive(experiment_folder, 'zip', rally_folder, request_name)
+def compress_output_data(deployment_id, request_name, archiver=None):
+    ensure_experiment_report(deployment_id, request_name)
+    # loads already archived by the experiment are only referenced, the rest is archived now
+    if not archiver:
+        archiver = ExperimentArchiver(deployment_id, request_name)
+    return archiver.finalize()
 
 
 def extract_traces(deployment_id, request_name, load_name):
@@ -172,17 +173,81 @@ def extract_traces(deployment_id, request_name, load_name):
                     for complete in iteration['output']['complete']:
                         traces.append(complete['data']['trace_id'])
     depl = Deployment.load(deployment_id)
+    connection_string = f"elasticsearch://{depl.get_control_url()}:9200"
+    trace_fetcher = TraceFetcher(depl.get_connection_string())
+    failed = {}
+    done = 0
+    extract_batch = process_registry.bind_context(extract_trace_batch)
+    with ThreadPoolExecutor(max_workers=TRACE_WORKERS) as executor:
+        futures = {executor.submit(extract_batch, trace_fetcher, traces[batch_start:batch_start + TRACE_BATCH],
+                                   connection_string, html_folder, json_folder): batch_start
+                   for batch_start in range(0, len(traces), TRACE_BATCH)}
+        for future in as_completed(futures):
+            batch_start = futures[future]
+            batch_failed = future.result()
+            for trace, error in batch_failed.items():
+                logging.error(f'Trace {trace} of {load_folder} could not be extracted: {error}')
+            failed.update(batch_failed)
+            previous_done = done
+            done = done + len(traces[batch_start:batch_start + TRACE_BATCH])
+            if done // TRACE_PROGRESS_STEP != previous_done // TRACE_PROGRESS_STEP or done == len(traces):
+                logging.info(f'Extracted {done}/{len(traces)} traces of {load_folder}, {len(failed)} failed')
+    trace_fetcher.close()
+    if failed:
+        with open(load_folder + FILE_TRACES_FAILED, "w") as failed_file:
+            json.dump(failed, failed_file, indent=2)
+    return {"traces": traces, "failed": list(failed)}
+
+
+def extract_trace_batch(trace_fetcher, traces, connection_string, html_folder, json_folder):
+    """Writes a batch of traces read from Elasticsearch, the osprofiler CLI is used for the ones not found.
+
+    Returns {trace id: error} for the traces that could not be extracted.
+    """
+    process_registry.check_cancelled()
+    try:
+        reports = trace_fetcher.fetch_batch(traces)
+    except Exception as e:
+        logging.warning(f'Reading traces from Elasticsearch failed, falling back to osprofiler: {e}')
+        reports = {}
+    failed = {}
     for trace in traces:
-        html_output_file = open(f"{html_folder}/{trace}.html", "a+")
-        subprocess.run(["osprofiler", "trace", "show", "--html", trace, "--connection-string",
-                        f"elasticsearch://{depl.get_control_url()}:9200"], stdin=subprocess.PIPE, stdout=html_output_file)
-        html_output_file.close()
-
-        json_output_file = open(f"{json_folder}/{trace}.json", "a+")
-        subprocess.run(["osprofiler", "trace", "show", "--json", trace, "--connection-string",
-                        f"elasticsearch://{depl.get_control_url()}:9200"], stdin=subprocess.PIPE, stdout=json_output_file)
-        json_output_file.close()
-    return {"traces": traces}
+        process_registry.check_cancelled()
+        try:
+            if trace in reports:
+                write_trace(trace, reports[trace], html_folder, json_folder)
+            else:
+                extract_trace(trace, connection_string, html_folder, json_folder)
+        except process_registry.RequestCancelled:
+            raise
+        except Exception as e:
+            failed[trace] = str(e)
+    return failed
+
+
+def write_trace(trace, report, html_folder, json_folder):
+    with open(f"{json_folder}/{trace}.json", "w") as json_output_file:
+        json_output_file.write(json.dumps(report, separators=(",", ": "), indent=2))
+    with open(f"{html_folder}/{trace}.html", "w") as html_output_file:
+        html_output_file.write(render_trace_html(report))
+
+
+def extract_trace(trace, connection_string, html_folder, json_folder):
+    output = process_registry.run(["osprofiler", "trace", "show", "--json", trace, "--connection-string",
+                             connection_string], stdin=subprocess.PIPE, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip() or f"osprofiler exited with {output.returncode}")
+    write_trace(trace, json.loads(output.stdout), html_folder, json_folder)
+
+
+def render_trace_html(trace):
+    # same page as "osprofiler trace show --html", rendered without a second Elasticsearch round trip
+    if not TRACE_HTML_TEMPLATE_DICT['value']:
+        import osprofiler.cmd
+        with open(os.path.join(os.path.dirname(osprofiler.cmd.__file__), "template.html")) as html_template:
+            TRACE_HTML_TEMPLATE_DICT['value'] = html_template.read()
+    trace_data = json.dumps(trace, indent=4, separators=(",", ": "))
+    return TRACE_HTML_TEMPLATE_DICT['value'].replace("$DATA", trace_data).replace("$LOCAL", "false")
 
 
 # depreciated
@@ -219,14 +284,12 @@ def extract_logs(deployment_id, task_name, load_name, time_start, time_end):
     time_start_string = time_start.strftime("%Y-%m-%dT%H:%M:00")
     time_end_string = time_end.strftime("%Y-%m-%dT%H:%M:59")
     deployment = Deployment.query.filter(Deployment.id == deployment_id).first()
-    search_body = "{\"query\":{\"range\":{\"@timestamp\":{\"gte\":\"" + time_start_string + "\",\"lt\":\"" \
-                  + time_end_string + "\",\"time_zone\":\"+02:00\"}}}}"
-    subprocess.run(["./node_modules/elasticdump/bin/elasticdump",
-                    f"--input=http://{deployment.get_control_url()}:9200/flog-*",
-                    f"--output={load_folder}{Deployment.LOG_DUMP}", "--overwrite", f"--searchBody={search_body}"], stdin=subprocess.PIPE)
-    print(search_body)
-    # "--searchBody=\"{\\\"query\\\":{\\\"range\\\":{\\\"@timestamp\\\":{\\\"gte\\\":\\\"2020-08-31T11:00:00\\\",\\\"lt\\\":\\\"2020-08-31T11:10:00\\\"}}}}\""
-    pass
+    search_query = {"range": {"@timestamp": {"gte": time_start_string,
+                                             "lt": time_end_string,
+                                             "time_zone": "+02:00"}}}
+    exported = log_exporter.export_logs(deployment.get_connection_string(), search_query,
+                                        f"{load_folder}{Deployment.LOG_DUMP}")
+    logging.info(f'Exported {exported} log entries of {load_folder} for {search_query}')
 
 
 def prepare_custom_load(config_id, load_code):
@@ -258,8 +321,78 @@ def prepare_load(deploy_id, name, kwargs):
 
 
 def get_full_html_report_file(deploy_id, task_name):
-    experiment_folder = get_experiment_folder(deploy_id, task_name)
-    return experiment_folder + RALLY_OUTPUT_HTML
+    return ensure_experiment_report(deploy_id, task_name, RALLY_OUTPUT_HTML)
+
+
+def get_full_json_report_file(deploy_id, task_name):
+    return ensure_experiment_report(deploy_id, task_name, RALLY_OUTPUT_JSON)
+
+
+def append_load_summary(deployment_id, request_name, load_name, task_name):
+    """Records a finished load in the experiment summary the combined report is built from."""
+    load_folder = get_load_folder(deployment_id, request_name, load_name)
+    summary = {'load': load_name, 'task': task_name, 'finished': datetime.now().strftime(DATETIME_FORMAT),
+               'iterations': 0, 'failed': 0, 'pass_sla': True}
+    if os.path.exists(load_folder + RALLY_OUTPUT_JSON):
+        with open(load_folder + RALLY_OUTPUT_JSON) as report_file:
+            report = json.load(report_file)
+        for task in report['tasks']:
+            summary['pass_sla'] = summary['pass_sla'] and task.get('pass_sla', True)
+            for subtask in task['subtasks']:
+                for workload in subtask['workloads']:
+                    summary['iterations'] += len(workload['data'])
+                    summary['failed'] += len([iteration for iteration in workload['data'] if iteration.get('error')])
+    with open(get_experiment_folder(deployment_id, request_name) + FILE_LOADS_SUMMARY, "a") as summary_file:
+        summary_file.write(json.dumps(summary) + "\n")
+
+
+def get_load_summaries(deployment_id, request_name):
+    summary_path = get_experiment_folder(deployment_id, request_name) + FILE_LOADS_SUMMARY
+    if not os.path.exists(summary_path):
+        return list()
+    with open(summary_path) as summary_file:
+        return [json.loads(line) for line in summary_file if line.strip()]
+
+
+def prune_load_summaries(deployment_id, request_name, load_names):
+    """Drops the summaries of loads not in `load_names`, left by an interrupted experiment."""
+    experiment_folder = get_experiment_folder(deployment_id, request_name)
+    summaries = [summary for summary in get_load_summaries(deployment_id, request_name)
+                 if summary['load'] in load_names]
+    with EXPERIMENT_REPORT_LOCK:
+        with open(experiment_folder + FILE_LOADS_SUMMARY, "w") as summary_file:
+            for summary in summaries:
+                summary_file.write(json.dumps(summary) + "\n")
+        if os.path.exists(experiment_folder + FILE_REPORT_STATE):
+            os.remove(experiment_folder + FILE_REPORT_STATE)
+
+
+def ensure_experiment_report(deployment_id, request_name, report_name=RALLY_OUTPUT_HTML):
+    """Builds the combined report of all loads of the experiment when it is behind the load summary.
+
+    The report is generated on request, only from the tasks of the experiment, and
+    regenerated only after more loads finished.
+    """
+    experiment_folder = get_experiment_folder(deployment_id, request_name)
+    tasks = [summary['task'] for summary in get_load_summaries(deployment_id, request_name) if summary.get('task')]
+    with EXPERIMENT_REPORT_LOCK:
+        state = {}
+        if os.path.exists(experiment_folder + FILE_REPORT_STATE):
+            state = read_json_file(experiment_folder + FILE_REPORT_STATE)
+        if not tasks or (state.get(report_name) == len(tasks) and os.path.exists(experiment_folder + report_name)):
+            return experiment_folder + report_name
+        report_arguments = ["rally", "task", "report", "--uuid", *tasks, "--out", report_name]
+        if report_name == RALLY_OUTPUT_JSON:
+            report_arguments.insert(3, "--json")
+        output = process_registry.run(report_arguments, cwd=experiment_folder, stdin=subprocess.PIPE,
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            logging.error(f'Rally report of {experiment_folder} failed: {output.stderr}')
+            return experiment_folder + report_name
+        state[report_name] = len(tasks)
+        with open(experiment_folder + FILE_REPORT_STATE, "w") as state_file:
+            json.dump(state, state_file)
+    return experiment_folder + report_name
 
 
 def get_html_report_file(deploy_id, task_name, load_id):
@@ -302,19 +435,59 @@ def get_traces_html_file(deployment_id, request_name, load_name, trace_file_id):
     return f"{get_load_folder(deployment_id, request_name, load_name)}/{TRACES_HTML_FOLDER}/{trace_file_id}.html"
 
 
-def get_full_dump_file(config_id, request_id):
-    return f"{get_rally_folder(config_id)}/{request_id}"
+def get_full_dump_file(config_id, request_name):
+    return get_container_path(config_id, request_name)
+
+
+def get_rally_driver(deployment_id, load_folder):
+    return get_driver(deployment_id, f'{load_folder}{RALLY_CONFIG_FILE}',
+                      ["rally_files/complete_test_run.py", get_anomaly_injection_path()],
+                      get_openstack_env(deployment_id))
 
 
 def verify_task(deployment_id, load_folder):
-    output = subprocess.run(["rally",
+    """Validates the task of the load, skipped when the same inputs were validated before."""
+    validation_key = validation_cache.get_validation_key(deployment_id, get_validation_inputs(load_folder))
+    if validation_cache.is_validated(deployment_id, validation_key):
+        return True
+    if not validate_task(deployment_id, load_folder):
+        return False
+    validation_cache.store_validation(deployment_id, validation_key)
+    return True
+
+
+def get_validation_inputs(load_folder):
+    # everything rally task validate reads besides the deployment: task, config and plugins
+    return [f'{load_folder}/{RALLY_TASK_SOURCE}', f'{load_folder}{RALLY_CONFIG_FILE}',
+            "rally_files/complete_test_run.py", get_anomaly_injection_path()]
+
+
+def validate_task(deployment_id, load_folder):
+    try:
+        get_rally_driver(deployment_id, load_folder).validate(f"deployment{deployment_id}",
+                                                              f'{load_folder}/{RALLY_TASK_SOURCE}')
+        return True
+    except RallyTaskError as e:
+        with open(f'{load_folder}/{FILE_RALLY_ERROR}', "w+") as text_file:
+            text_file.write(str(e))
+        return False
+    except RallyDriverUnavailable as e:
+        # the worker was killed when the request was cancelled
+        process_registry.check_cancelled()
+        logging.warning(f'Validating with the rally CLI, Rally API is unavailable: {e}')
+    return verify_task_cli(deployment_id, load_folder)
+
+
+def verify_task_cli(deployment_id, load_folder):
+    output = process_registry.run(["rally",
                              "--config-file", "rally_files/rally.conf",
                              "--plugin-paths",
                              "rally_files/complete_test_run.py," + get_anomaly_injection_path(),
                              "task", "validate",
                              f'{load_folder}/{RALLY_TASK_SOURCE}',
                              "--deployment", f"deployment{deployment_id}"],
-                            capture_output=True, stdin=subprocess.PIPE, text=True)
+                            capture_output=True, stdin=subprocess.PIPE, text=True,
+                            env=get_openstack_env(deployment_id))
     if output.returncode == 0:
         return True
     with open(f'{load_folder}/{FILE_RALLY_ERROR}', "w+") as text_file:
@@ -333,7 +506,6 @@ def get_task_name(file_path):
 
 
 def run_load(deployment_id, request_name, load_name, workload, config):
-    experiment_folder = get_experiment_folder(deployment_id, request_name)
     load_folder = get_load_folder(deployment_id, request_name, load_name)
     utils.ensure_folder(load_folder)
     task_file = load_folder + RALLY_TASK_SOURCE
@@ -345,9 +517,40 @@ def run_load(deployment_id, request_name, load_name, workload, config):
     if not verify_task(deployment_id, load_folder):
         return False
     file_log_path = f"{load_folder}{FILE_RALLY_LOG}"
+    shutil.copyfile(get_deployment_folder(deployment_id) + '/multinode', load_folder + '/multinode')
+    try:
+        task_name = run_task(deployment_id, load_folder, file_log_path)
+    except RallyDriverUnavailable as e:
+        # the worker was killed when the request was cancelled
+        process_registry.check_cancelled()
+        logging.warning(f'Running {load_folder} with the rally CLI, Rally API is unavailable: {e}')
+        task_name = run_task_cli(deployment_id, load_folder, file_log_path)
+    add_trace_hrefs_to_rally(deployment_id, load_folder)
+    append_load_summary(deployment_id, request_name, load_name, task_name)
+    return True
+
+
+def run_task(deployment_id, load_folder, file_log_path):
+    driver = get_rally_driver(deployment_id, load_folder)
+    try:
+        task_name = driver.start(f"deployment{deployment_id}", load_folder + RALLY_TASK_SOURCE, file_log_path)
+    except RallyTaskError as e:
+        # like the CLI, a failed task still gets its reports
+        logging.error(f'Rally task of {load_folder} failed: {e}')
+        task_name = get_task_name(file_log_path)
+        if not task_name:
+            raise
+    for output_type, output_file in [("html", RALLY_OUTPUT_HTML), ("json", RALLY_OUTPUT_JSON)]:
+        try:
+            driver.report([task_name], output_type, load_folder + output_file)
+        except RallyTaskError as e:
+            logging.error(f'Rally {output_type} report of {load_folder} failed: {e}')
+    return task_name
+
+
+def run_task_cli(deployment_id, load_folder, file_log_path):
     file_log = open(file_log_path, "a+")
     file_log.flush()
-    shutil.copyfile(get_deployment_folder(deployment_id) + '/multinode', load_folder + '/multinode')
     rally_run_arguments = ["rally",
                     "--config-file", RALLY_CONFIG_FILE,
                     "--plugin-paths", "../../../../../rally_files/complete_test_run.py,"
@@ -356,24 +559,22 @@ def run_load(deployment_id, request_name, load_name, workload, config):
                     RALLY_TASK_SOURCE,
                     "--deployment", f"deployment{deployment_id}"]
     file_log.write('executing rally command: '+ ' '.join(rally_run_arguments))
-    subprocess.run(rally_run_arguments,
+    process_registry.run(rally_run_arguments,
                    cwd=load_folder,
                    stdin=subprocess.PIPE,
-                   stdout=file_log)
+                   stdout=file_log,
+                   env=get_openstack_env(deployment_id))
     task_name = get_task_name(file_log_path)
-    subprocess.run(["rally", "task", "report", task_name, "--out",
+    process_registry.run(["rally", "task", "report", task_name, "--out",
                     RALLY_OUTPUT_HTML],
                    cwd=load_folder,
                    stdin=subprocess.PIPE,
                    stdout=file_log)
-    subprocess.run(
+    process_registry.run(
         ["rally", "task", "report", task_name, "--json", "--out", RALLY_OUTPUT_JSON],
         cwd=load_folder, stdin=subprocess.PIPE, stdout=file_log)
-    add_trace_hrefs_to_rally(deployment_id, load_folder)
-    subprocess.run(
-        ["rally", "task", "report", "--deployment", f"deployment{deployment_id}", "--out", RALLY_OUTPUT_HTML],
-        cwd=experiment_folder, stdin=subprocess.PIPE, stdout=file_log)
-    return True
+    file_log.close()
+    return task_name
 
 
 def get_experiment_results(config_id, task_name):
@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+import threading
+
+import numpy as np
+
+from openstack_tools.prometheus_fetcher import stitch_chunks
+
+FILE_RAW_METRICS = "raw_metrics.jsonl.gz"
+
+RECORD_HEADER = "header"
+RECORD_METRIC = "metric"
+RECORD_CUSTOM = "custom"
+
+
+class RawMetricsStore:
+    """Gzip compressed JSON lines file with the raw query_range responses of one load.
+
+    The first record describes the load window and the queried series, every
+    following record holds one response. Records are appended as separate gzip
+    members, so the store can be extended by several writers over time and a
+    query may be stored as several consecutive windows.
+    """
+
+    def __init__(self, load_folder):
+        self.path = load_folder + FILE_RAW_METRICS
+        self.lock = threading.Lock()
+        self.records = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def write_header(self, start, end, selector, metrics, node_domains, append=False):
+        """Starts a new store, or appends a header replacing the previous one when `append` is set."""
+        with self.lock:
+            with gzip.open(self.path, 'at' if append else 'wt') as store_file:
+                store_file.write(json.dumps({'type': RECORD_HEADER,
+                                             'start': start.timestamp(),
+                                             'end': end.timestamp(),
+                                             'selector': selector,
+                                             'metrics': metrics,
+                                             'node_domains': node_domains}) + '\n')
+
+    def append(self, kind, query, data):
+        line = json.dumps({'type': kind, 'query': query, 'data': data}, default=encode_array) + '\n'
+        with self.lock:
+            with gzip.open(self.path, 'at') as store_file:
+                store_file.write(line)
+
+    def load(self):
+        header = None
+        records = {RECORD_METRIC: {}, RECORD_CUSTOM: {}}
+        with gzip.open(self.path, 'rt') as store_file:
+            for line in store_file:
+                record = json.loads(line)
+                if record['type'] == RECORD_HEADER:
+                    # the latest header describes the whole store
+                    header = record
+                else:
+                    records[record['type']].setdefault(record['query'], list()).append(record['data'])
+        return header, records
+
+    def get_header(self):
+        return self.get_records()[0]
+
+    def get_records(self):
+        if self.records is None:
+            self.records = self.load()
+        return self.records
+
+    def responds(self, kind, queries):
+        """Yields (query, result) for every stored query, windows stitched in stored order."""
+        records = self.get_records()[1][kind]
+        for query in queries:
+            if query in records:
+                yield query, stitch_chunks(records[query])
+
+
+def metric_instances(metrics):
+    """Instances having a series of any metric of {metric: instances}, in metric order."""
+    return list(dict.fromkeys(instance for metric in sorted(metrics) for instance in sorted(metrics[metric])))
+
+
+def encode_array(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value)} can not be stored')
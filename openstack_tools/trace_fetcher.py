@@ -0,0 +1,127 @@
+import datetime
+import json
+
+import requests
+
+OSPROFILER_INDEX = "osprofiler-notifications"
+# trace ids looked up by one _msearch request
+TRACE_BATCH = 50
+# Elasticsearch index.max_result_window default, bigger traces are left to the osprofiler CLI
+MAX_NOTIFICATIONS = 10000
+TRACE_TIMEOUT = 120
+NOTIFICATION_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class TraceFetcher:
+    """Reads osprofiler notifications of many traces from Elasticsearch at once.
+
+    One _msearch request looks up a whole batch of trace ids, and the span tree
+    of every trace is assembled in Python into the report "osprofiler trace show"
+    would print.
+    """
+
+    def __init__(self, elasticsearch_url):
+        self.elasticsearch_url = elasticsearch_url
+        self.session = requests.Session()
+
+    def close(self):
+        self.session.close()
+
+    def fetch_batch(self, trace_ids):
+        """Returns {trace id: report} for the traces of the batch found completely."""
+        body = ""
+        for trace_id in trace_ids:
+            body += json.dumps({"index": OSPROFILER_INDEX}) + "\n"
+            body += json.dumps({"query": {"match": {"base_id": trace_id}}, "size": MAX_NOTIFICATIONS}) + "\n"
+        response = self.session.post(f"{self.elasticsearch_url}/_msearch", data=body,
+                                     headers={"Content-Type": "application/x-ndjson"}, timeout=TRACE_TIMEOUT)
+        response.raise_for_status()
+        reports = {}
+        for trace_id, result in zip(trace_ids, response.json()['responses']):
+            if 'error' in result:
+                continue
+            hits = result['hits']['hits']
+            total = result['hits']['total']
+            if isinstance(total, dict):
+                total = total['value']
+            if not hits or total > len(hits):
+                continue
+            notifications = [hit['_source'] for hit in hits if hit['_source'].get('base_id') == trace_id]
+            if notifications:
+                reports[trace_id] = build_trace_report(notifications)
+        return reports
+
+
+def build_trace_report(notifications):
+    """Assembles notifications of one trace the way osprofiler drivers build their report."""
+    nodes = {}
+    started_at = None
+    finished_at = None
+    last_started_at = None
+    for notification in notifications:
+        trace_id = notification["trace_id"]
+        name = notification["name"]
+        timestamp = datetime.datetime.strptime(notification["timestamp"], NOTIFICATION_TIME_FORMAT)
+        if trace_id not in nodes:
+            nodes[trace_id] = {"info": {"name": name.split("-")[0],
+                                        "project": notification["project"],
+                                        "service": notification["service"],
+                                        "host": notification["info"]["host"]},
+                               "trace_id": trace_id,
+                               "parent_id": notification["parent_id"],
+                               # leaves keep an empty list, as in the osprofiler report
+                               "children": list()}
+        info = nodes[trace_id]["info"]
+        info[f"meta.raw_payload.{name}"] = notification
+        if name.endswith("stop"):
+            info["finished"] = timestamp
+            info["exception"] = "None"
+            if "info" in notification:
+                info["exception"] = notification["info"].get("etype", "None")
+        else:
+            info["started"] = timestamp
+            if not last_started_at or last_started_at < timestamp:
+                last_started_at = timestamp
+        if not started_at or started_at > timestamp:
+            started_at = timestamp
+        if not finished_at or finished_at < timestamp:
+            finished_at = timestamp
+
+    stats = {}
+    for node in nodes.values():
+        info = node["info"]
+        if "started" not in info:
+            info["started"] = info["finished"]
+        if "finished" not in info:
+            info["finished"] = info["started"]
+        info["started"] = milliseconds(info["started"] - started_at)
+        info["finished"] = milliseconds(info["finished"] - started_at)
+        duration = info["finished"] - info["started"]
+        if info["name"] not in stats:
+            stats[info["name"]] = {"count": 0, "duration": 0}
+        stats[info["name"]]["count"] += 1
+        stats[info["name"]]["duration"] += duration
+
+    return {"info": {"name": "total",
+                     "started": 0,
+                     "finished": milliseconds(finished_at - started_at),
+                     "last_trace_started": milliseconds(last_started_at - started_at)},
+            "children": build_tree(nodes),
+            "stats": stats}
+
+
+def build_tree(nodes):
+    tree = list()
+    for node in nodes.values():
+        parent_id = node["parent_id"]
+        if parent_id in nodes:
+            nodes[parent_id]["children"].append(node)
+        else:
+            tree.append(node)
+    for node in nodes.values():
+        node["children"].sort(key=lambda child: child["info"]["started"])
+    return sorted(tree, key=lambda node: node["info"]["started"])
+
+
+def milliseconds(delta):
+    return int((delta.microseconds + (delta.seconds + delta.days * 24 * 3600) * 1e6) / 1000.0)
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+from utils import DATETIME_FORMAT, get_deployment_folder, read_json_file
+
+FILE_VALIDATION_CACHE = "validation_cache.json"
+
+VALIDATION_CACHE_LOCK = threading.Lock()
+
+
+def get_validation_key(deployment_id, input_paths):
+    """Digest of the deployment and of every file rally task validate reads."""
+    digest = hashlib.sha256(f"deployment{deployment_id}".encode())
+    for file_path in input_paths:
+        with open(file_path, 'rb') as input_file:
+            content = input_file.read()
+        digest.update(f"{len(content)}:".encode())
+        digest.update(content)
+    return digest.hexdigest()
+
+
+def is_validated(deployment_id, validation_key):
+    return validation_key in read_validation_cache(deployment_id)
+
+
+def store_validation(deployment_id, validation_key):
+    with VALIDATION_CACHE_LOCK:
+        validation_cache = read_validation_cache(deployment_id)
+        validation_cache[validation_key] = datetime.now().strftime(DATETIME_FORMAT)
+        with open(get_deployment_folder(deployment_id) + FILE_VALIDATION_CACHE, "w") as cache_file:
+            json.dump(validation_cache, cache_file, indent=2)
+
+
+def read_validation_cache(deployment_id):
+    cache_path = get_deployment_folder(deployment_id) + FILE_VALIDATION_CACHE
+    if not os.path.exists(cache_path):
+        return {}
+    return read_json_file(cache_path)
+
+
+def clear_validation_cache(deployment_id):
+    with VALIDATION_CACHE_LOCK:
+        cache_path = get_deployment_folder(deployment_id) + FILE_VALIDATION_CACHE
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
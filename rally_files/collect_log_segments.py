@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Packs the bytes appended to the kolla logs of this host since the previous collection.
+
+Usage: collect_log_segments.py <offsets json> <archive path>
+
+The offsets map the inode of every log file to the byte offset read up to.
+Files are tracked by inode, so a log renamed by logrotate continues where it
+was left. The archive holds one member per log file with the new bytes, at the
+path of the file below /var/log/kolla, and index.json with the segments and
+the offsets for the next collection.
+"""
+import io
+import json
+import os
+import sys
+import tarfile
+
+LOG_ROOT = "/var/log/kolla"
+INDEX_MEMBER = "index.json"
+
+
+def main(offsets_json, archive_path):
+    offsets = json.loads(offsets_json)
+    new_offsets = {}
+    segments = list()
+    with tarfile.open(archive_path, "w:gz") as archive:
+        for root, dirs, files in os.walk(LOG_ROOT):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                # compressed rotations hold bytes already read before the rotation
+                if name.endswith(".gz") or os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                inode = str(stat.st_ino)
+                relative_path = os.path.relpath(path, LOG_ROOT)
+                start = offsets.get(inode, {}).get("offset", 0)
+                if start > stat.st_size:
+                    # truncated in place, read again from the beginning
+                    start = 0
+                end = stat.st_size
+                new_offsets[inode] = {"file": relative_path, "offset": end}
+                if end == start:
+                    continue
+                member = tarfile.TarInfo(relative_path)
+                member.size = end - start
+                member.mtime = stat.st_mtime
+                with open(path, "rb") as log_file:
+                    log_file.seek(start)
+                    archive.addfile(member, log_file)
+                segments.append({"file": relative_path, "inode": inode, "start": start, "end": end,
+                                 "segment": relative_path})
+        index = json.dumps({"segments": segments, "offsets": new_offsets}).encode()
+        member = tarfile.TarInfo(INDEX_MEMBER)
+        member.size = len(index)
+        archive.addfile(member, io.BytesIO(index))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
@@ -10,6 +10,7 @@ config_blueprint = Blueprint('configs', __name__, url_prefix='/configs')
 
 import app
 from models.deployment import Deployment
+from cloud_components import request_events
 from cloud_components.request_executor import RequestExecutor
 from utils import DEPLOY_FOLDER_LSTRIP
 
@@ -169,6 +170,17 @@ def rally_error(config_id, request_id, load_id):
     file = rally_manager.get_error_file(config_id, request.get_task_name(), load_id)
     return send_file(file, mimetype='text/plain')
 
+@config_blueprint.route('/<int:config_id>/requests/experiment/<int:request_id>/<load_id>/rebuild_metrics')
+def rebuild_metrics(config_id, request_id, load_id):
+    request = RequestExecutor.query.filter(RequestExecutor.id==request_id).first()
+    kwargs = request.get_kwargs_dictionary()
+    from openstack_tools.metrics_collector import MetricsCollector
+    metrics_collector = MetricsCollector.from_raw_store(config_id, request.get_task_name(), load_id,
+                                                        kwargs.get('metrics_allowlist'),
+                                                        kwargs.get('metrics_denylist'),
+                                                        kwargs.get('metrics_format'))
+    return metrics_collector.rebuild_metrics()
+
 @config_blueprint.route('/<int:deployment_id>/requests/experiment/<int:request_id>/<load_id>/traces/<trace_file_id>')
 def show_traces_html(deployment_id, request_id, load_id, trace_file_id):
     request = RequestExecutor.query.filter(RequestExecutor.id == request_id).first()
@@ -180,7 +192,7 @@ def show_traces_html(deployment_id, request_id, load_id, trace_file_id):
 def get_full_dump(config_id, request_id):
     request = RequestExecutor.query.filter(RequestExecutor.id == request_id).first()
     from openstack_tools import rally_manager
-    return send_file(rally_manager.get_full_dump_file(config_id, request.get_task_name()+'.zip'))
+    return send_file(rally_manager.get_full_dump_file(config_id, request.get_task_name()))
 
 @config_blueprint.route('/<int:config_id>/requests/experiment/<int:request_id>/html_report')
 def get_full_html_report(config_id, request_id):
@@ -207,6 +219,24 @@ def deploy_log(config_id):
     return send_file(file, mimetype='text/plain')
 
 
+@config_blueprint.route('/<int:config_id>/events')
+def deployment_events(config_id):
+    """Server-sent events of the requests of the deployment and the lines appended to its log.
+
+    The log is followed from its end, or from the byte offset given as ?log=.
+    """
+    from openstack_tools import openstack_manager
+    log_files = {'log': openstack_manager.get_deploy_log(config_id)}
+    log_offsets = {name: request.args.get(name, type=int) for name in log_files}
+    # EventSource can not set headers on its first connection
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    stream = request_events.open_stream(
+        config_id, log_files, last_event_id, log_offsets,
+        lambda: [queued_request.to_string() for queued_request in app.get_request_manager().get_schedule(config_id)])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @config_blueprint.route('/<int:config_id>/test')
 def test(config_id):
     test_request = RequestExecutor(deploy_id=config_id,
@@ -0,0 +1,139 @@
+import json
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import snappy
+
+from openstack_tools.prometheus_remote_read import LOOKBACK_DELTA, STALE_NAN, encode_field, encode_varint, \
+    iter_fields
+
+
+class PrometheusServer:
+    """Local stand-in for the query_range and remote read APIs of Prometheus.
+
+    `series` is a list of (labels, timestamps in seconds, values). query_range
+    evaluates every step like Prometheus does for a plain series selector: the
+    latest sample at most LOOKBACK_DELTA old, unless it is a stale marker.
+    `statuses` are answered, one per request, before any request is served.
+    """
+
+    def __init__(self, series=(), statuses=()):
+        self.series = list(series)
+        self.statuses = list(statuses)
+        self.paths = list()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self, parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if urlparse(self.path).path.endswith("api/v1/read"):
+                    server.handle_read(self, body)
+                else:
+                    server.handle(self, parse_qs(body.decode()))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def answer_status(self, handler):
+        self.paths.append(urlparse(handler.path).path)
+        if not self.statuses:
+            return False
+        handler.send_response(self.statuses.pop(0))
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return True
+
+    def handle(self, handler, params):
+        if self.answer_status(handler):
+            return
+        metric = params['query'][0].split("{")[0]
+        start, end, step = (float(params[name][0]) for name in ('start', 'end', 'step'))
+        result = list()
+        for labels, timestamps, values in self.matching(metric):
+            points = list()
+            for point in start + step * np.arange(int((end - start) // step) + 1):
+                position = np.searchsorted(timestamps, point, side='right') - 1
+                if position < 0 or point - timestamps[position] > LOOKBACK_DELTA \
+                        or np.float64(values[position]).view(np.uint64) == STALE_NAN:
+                    continue
+                points.append([float(point), repr(float(values[position]))])
+            if points:
+                result.append({'metric': labels, 'values': points})
+        self.send(handler, 'application/json',
+                  json.dumps({'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}).encode())
+
+    def handle_read(self, handler, body):
+        if self.answer_status(handler):
+            return
+        request = memoryview(snappy.uncompress(body))
+        response = b''
+        for _, _, (query_start, query_end) in iter_fields(request, 0, len(request)):
+            fields = {}
+            matchers = list()
+            for field, _, value in iter_fields(request, query_start, query_end):
+                if field == 3:
+                    matchers.append(decode_strings(request, *value))
+                else:
+                    fields[field] = value
+            metric = next(matcher[3] for matcher in matchers if matcher[2] == '__name__')
+            timeseries = b''
+            for labels, timestamps, values in self.matching(metric):
+                selected = (timestamps * 1000 >= fields.get(1, 0)) & (timestamps * 1000 <= fields.get(2, 0))
+                timeseries += encode_field(1, encode_timeseries(labels, timestamps[selected], values[selected]))
+            response += encode_field(1, timeseries)
+        self.send(handler, 'application/x-protobuf', snappy.compress(response))
+
+    def matching(self, metric):
+        return [series for series in self.series if series[0]['__name__'] == metric]
+
+    def send(self, handler, content_type, body):
+        handler.send_response(200)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def decode_strings(buffer, start, end):
+    """Returns {field number: value} of a message, length delimited fields decoded as strings."""
+    fields = {}
+    for field, wire_type, value in iter_fields(buffer, start, end):
+        fields[field] = bytes(buffer[value[0]:value[1]]).decode() if wire_type == 2 else value
+    return fields
+
+
+def encode_timeseries(labels, timestamps, values):
+    """Encodes a prompb TimeSeries the way proto3 does, fields at their default are left out."""
+    message = b''
+    for name, value in labels.items():
+        message += encode_field(1, encode_field(1, name.encode()) + encode_field(2, value.encode()))
+    for timestamp, value in zip(timestamps, values):
+        sample = b''
+        if value != 0 or np.signbit(value):
+            sample += encode_varint(1 << 3 | 1) + struct.pack('<d', value)
+        timestamp_ms = int(round(timestamp * 1000))
+        if timestamp_ms:
+            sample += encode_varint(2 << 3) + encode_varint(timestamp_ms)
+        message += encode_field(2, sample)
+    return message
@@ -0,0 +1,65 @@
+import json
+import os
+import tarfile
+
+from openstack_tools.experiment_archiver import ExperimentArchiver
+from utils import get_experiment_folder
+
+REQUEST_NAME = "01.03.23_10:00:00"
+
+
+def make_experiment(tmp_path, monkeypatch, load_names):
+    monkeypatch.chdir(tmp_path)
+    experiment_folder = get_experiment_folder(1, REQUEST_NAME)
+    for load_name in load_names:
+        os.makedirs(f"{experiment_folder}{load_name}")
+        with open(f"{experiment_folder}{load_name}/rally_report.json", "w") as report:
+            report.write(json.dumps({'load': load_name}))
+    with open(f"{experiment_folder}experiment_report.html", "w") as report:
+        report.write("<html></html>")
+    return experiment_folder
+
+
+def interrupt(archiver):
+    # the process died after the archived loads were added, finalize never ran
+    for future in archiver.futures:
+        future.result()
+    archiver.executor.shutdown(wait=True)
+
+
+def container_members(archiver):
+    """Names of the load archives in container order, then the experiment files sorted."""
+    with tarfile.open(archiver.container_path) as container:
+        names = [member.name.split("/")[1].split(".")[0] for member in container.getmembers()]
+    load_count = len(archiver.manifest['loads'])
+    return names[:load_count] + sorted(names[load_count:])
+
+
+def test_resumed_archiver_adds_only_the_missing_loads(tmp_path, monkeypatch):
+    make_experiment(tmp_path, monkeypatch, ["load1", "load2"])
+    archiver = ExperimentArchiver(1, REQUEST_NAME)
+    archiver.archive_load("load1")
+    interrupt(archiver)
+
+    resumed = ExperimentArchiver(1, REQUEST_NAME)
+    assert resumed.submitted == {"load1"}
+    resumed.finalize()
+
+    assert container_members(resumed) == ["load1", "load2", "archive_manifest", "experiment_report"]
+    assert sorted(resumed.manifest['loads']) == ["load1", "load2"]
+
+
+def test_repeated_finalize_replaces_the_experiment_files(tmp_path, monkeypatch):
+    experiment_folder = make_experiment(tmp_path, monkeypatch, ["load1"])
+    ExperimentArchiver(1, REQUEST_NAME).finalize()
+    os.makedirs(f"{experiment_folder}load2")
+    with open(f"{experiment_folder}summary.csv", "w") as summary:
+        summary.write("load,duration\n")
+
+    archiver = ExperimentArchiver(1, REQUEST_NAME)
+    archiver.finalize()
+
+    assert container_members(archiver) == ["load1", "load2", "archive_manifest", "experiment_report", "summary"]
+    with tarfile.open(archiver.container_path) as container:
+        manifest = json.load(container.extractfile(f"{REQUEST_NAME}/archive_manifest.json"))
+    assert sorted(manifest['loads']) == ["load1", "load2"]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from openstack_tools.metric_frame_builder import MetricFrameBuilder, series_values
+
+
+def test_build_aligns_series_on_the_union_of_timestamps():
+    builder = MetricFrameBuilder()
+    builder.add('node1', 'cpu', [[20, '0.5'], [10, '0.25']])
+    builder.add('node1', 'memory', [[10, '100'], [30, '300']])
+
+    dt = builder.build('node1')
+
+    assert list(dt.columns) == ['timestamp', 'cpu', 'memory']
+    assert dt['timestamp'].tolist() == [10, 20, 30]
+    assert dt['cpu'].tolist()[:2] == [0.25, 0.5] and np.isnan(dt['cpu'][2])
+    assert np.isnan(dt['memory'][1]) and dt['memory'][[0, 2]].tolist() == [100, 300]
+
+
+def test_build_matches_column_by_column_merge():
+    series = {'cpu': [[10, '1'], [20, '2']], 'disk': [[20, '5'], [40, '7']], 'net': [[0, '3']]}
+    builder = MetricFrameBuilder()
+    expected = pd.DataFrame(columns=['timestamp'])
+    for title, values in series.items():
+        builder.add('node1', title, values)
+        column = pd.DataFrame({'timestamp': [float(value[0]) for value in values],
+                               title: [float(value[1]) for value in values]})
+        expected = expected.merge(column, on='timestamp', how='outer')
+
+    dt = builder.build('node1')
+
+    pd.testing.assert_frame_equal(dt, expected.sort_values('timestamp').reset_index(drop=True),
+                                  check_dtype=False)
+
+
+def test_repeated_title_replaces_the_column():
+    builder = MetricFrameBuilder()
+    builder.add('node1', 'cpu', [[10, '1']])
+    builder.add('node1', 'cpu', [[10, '2']])
+
+    dt = builder.build('node1')
+
+    assert list(dt.columns) == ['timestamp', 'cpu']
+    assert dt['cpu'].tolist() == [2.0]
+
+
+def test_keys_are_built_separately_and_once():
+    builder = MetricFrameBuilder()
+    builder.add(('cpu', 'node1'), 'user', [[10, '1']])
+    builder.add(('cpu', 'node2'), 'user', series_values({'timestamps': [10.0, 20.0], 'samples': [3.0, 4.0]}))
+
+    assert builder.keys() == [('cpu', 'node1'), ('cpu', 'node2')]
+    assert builder.build(('cpu', 'node2'))['user'].tolist() == [3.0, 4.0]
+    assert builder.build(('cpu', 'node2')).empty
+    assert builder.build('missing').empty
@@ -0,0 +1,39 @@
+import os
+import threading
+import time
+
+import pytest
+
+from cloud_components import process_registry
+
+
+def test_cancel_waits_for_process_tree_and_forget_prunes(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_registry, "CANCEL_GRACE_PERIOD", 0.5)
+    pid_file = tmp_path / "child.pid"
+    outcome = {}
+
+    def work():
+        with process_registry.request_context(41):
+            try:
+                # the child ignores SIGTERM and has to be killed after the grace period
+                process_registry.run(["sh", "-c", f"(trap '' TERM; sleep 30) & "
+                                                  f"echo $! > {pid_file}; wait"])
+            except process_registry.RequestCancelled:
+                outcome['cancelled'] = time.monotonic()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    while not pid_file.exists() or not pid_file.read_text().strip():
+        time.sleep(0.05)
+    child_pid = int(pid_file.read_text())
+
+    assert process_registry.cancel(41) == 1
+    thread.join(10)
+
+    assert 'cancelled' in outcome
+    with pytest.raises(ProcessLookupError):
+        os.kill(child_pid, 0)
+    assert process_registry.is_cancelled(41)
+    process_registry.forget(41)
+    assert not process_registry.is_cancelled(41)
+    assert 41 not in process_registry.PROCESSES_DICT
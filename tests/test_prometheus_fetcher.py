@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from openstack_tools.prometheus_fetcher import PrometheusFetcher, split_window, stitch_chunks
+from tests.prometheus_server import PrometheusServer
+
+START = datetime(2023, 3, 1, 10, 0, 0)
+STEP = 10
+
+
+def grid(windows):
+    return [START + timedelta(seconds=offset) for window_start, window_end in windows
+            for offset in range(int((window_start - START).total_seconds()),
+                                int((window_end - START).total_seconds()) + 1, STEP)]
+
+
+@pytest.mark.parametrize("points", [1, 4, 5, 6, 9, 10, 11])
+def test_split_window_covers_every_step_once(points):
+    end = START + timedelta(seconds=STEP * (points - 1))
+
+    windows = split_window(START, end, STEP, 5)
+
+    assert grid(windows) == grid([(START, end)])
+    assert all(len(grid([window])) <= 5 for window in windows)
+    assert windows[0][0] == START and windows[-1][1] == end
+
+
+def test_split_window_with_end_off_the_step_grid():
+    end = START + timedelta(seconds=STEP * 9 + 3)
+
+    windows = split_window(START, end, STEP, 5)
+
+    # a single query evaluates up to the last step before the end, so do the windows
+    assert windows == [(START, START + timedelta(seconds=40)),
+                       (START + timedelta(seconds=50), START + timedelta(seconds=90))]
+    assert grid(windows) == grid([(START, end)])
+
+
+def test_stitch_drops_overlapping_samples():
+    labels = {'__name__': 'node_load1', 'instance': '10.0.0.1'}
+    chunks = [{'resultType': 'matrix', 'result': [{'metric': labels, 'values': [[0, '1'], [10, '2'], [20, '3']]}]},
+              {'resultType': 'matrix', 'result': [{'metric': labels, 'values': [[20, '3'], [30, '4']]},
+                                                  {'metric': {'__name__': 'up'}, 'values': [[30, '1']]}]}]
+
+    stitched = stitch_chunks(chunks)
+
+    assert stitched['result'] == [{'metric': labels, 'values': [[0, '1'], [10, '2'], [20, '3'], [30, '4']]},
+                                  {'metric': {'__name__': 'up'}, 'values': [[30, '1']]}]
+
+
+def test_stitch_drops_overlapping_remote_read_samples():
+    labels = {'__name__': 'node_load1'}
+    chunks = [{'resultType': 'matrix', 'result': [{'metric': labels, 'timestamps': [0, 10], 'samples': [1.0, 2.0]}]},
+              {'resultType': 'matrix', 'result': [{'metric': labels, 'timestamps': [10, 20], 'samples': [2.0, 3.0]}]}]
+
+    stitched = stitch_chunks(chunks)
+
+    assert stitched['result'] == [{'metric': labels, 'timestamps': [0, 10, 20], 'samples': [1.0, 2.0, 3.0]}]
+
+
+def test_bad_request_is_raised_without_retries():
+    with PrometheusServer(statuses=[400]) as server:
+        fetcher = PrometheusFetcher(server.url, STEP, workers=1, backoff=10)
+        try:
+            with pytest.raises(requests.HTTPError):
+                fetcher.get("api/v1/query_range", {'query': 'rate(', 'start': 0, 'end': 10, 'step': STEP})
+        finally:
+            fetcher.close()
+
+    assert len(server.paths) == 1
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_transient_errors_are_retried(status):
+    series = [({'__name__': 'up', 'instance': '10.0.0.1'}, [START.timestamp()], [1.0])]
+    with PrometheusServer(series, statuses=[status, status]) as server:
+        fetcher = PrometheusFetcher(server.url, STEP, workers=1, backoff=0.01)
+        try:
+            result = fetcher.query_range('up', START, START + timedelta(seconds=STEP))
+        finally:
+            fetcher.close()
+
+    assert len(server.paths) == 3
+    assert result['result'][0]['values'][0][1] == '1.0'
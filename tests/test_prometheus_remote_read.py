@@ -0,0 +1,100 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import snappy
+
+from openstack_tools.metric_frame_builder import series_values
+from openstack_tools.prometheus_fetcher import PrometheusFetcher
+from openstack_tools.prometheus_remote_read import MATCH_EQUAL, MATCH_REGEXP, STALE_NAN, RemoteReader, \
+    decode_read_response, encode_field, encode_query, encode_read_request
+from tests.prometheus_server import PrometheusServer, encode_timeseries
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+# the fixtures were serialized by the protobuf classes generated from Prometheus prompb/remote.proto
+# and prompb/types.proto, and compressed by python-snappy
+START_MS = 1677664200000
+END_MS = 1677667800000
+METRICS = ["node_load1", "container_memory_usage_bytes"]
+MATCHERS = [(MATCH_REGEXP, 'job', 'cadvisor|node'),
+            (MATCH_REGEXP, 'instance', r'(10\.0\.0\.1|10\.0\.0\.2)(:[0-9]+)?')]
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as fixture:
+        return fixture.read()
+
+
+def test_request_matches_prompb():
+    queries = [encode_query(START_MS, END_MS, [(MATCH_EQUAL, '__name__', metric)] + MATCHERS) for metric in METRICS]
+    request = encode_read_request(queries)
+
+    assert request == snappy.uncompress(read_fixture("remote_read_request.snappy"))
+
+
+def test_response_decodes_prompb():
+    expected = json.loads(read_fixture("remote_read_response.json"))
+
+    results = decode_read_response(snappy.uncompress(read_fixture("remote_read_response.snappy")))
+
+    assert len(results) == len(expected)
+    for timeseries, expected_timeseries in zip(results, expected):
+        assert len(timeseries) == len(expected_timeseries)
+        for (labels, timestamps, values), expected_series in zip(timeseries, expected_timeseries):
+            assert labels == expected_series['labels']
+            np.testing.assert_array_equal(timestamps, np.array(expected_series['timestamps_ms']) / 1000.0)
+            # compared bit for bit, the stale marker is a NaN
+            assert values.view(np.uint64).tolist() == expected_series['value_bits']
+
+
+def test_regular_and_irregular_samples_decode_alike():
+    rng = np.random.default_rng(7)
+    timestamps = 1677664200 + np.arange(500) * 15.0
+    values = rng.random(500)
+    # zero values, a stale marker and a timestamp before 1971 leave the regular encoding
+    values[[0, 1, 70, 71, 72, 300, 499]] = 0.0
+    values[200] = np.uint64(STALE_NAN).view(np.float64)
+    timestamps[400] = 1000.0
+    labels = {'__name__': 'node_load1', 'instance': '10.0.0.1:9100'}
+    response = encode_field(1, encode_field(1, encode_timeseries(labels, timestamps, values)))
+
+    [[(decoded_labels, decoded_timestamps, decoded_values)]] = decode_read_response(response)
+
+    assert decoded_labels == labels
+    np.testing.assert_array_equal(decoded_timestamps, timestamps)
+    assert decoded_values.view(np.uint64).tolist() == values.view(np.uint64).tolist()
+
+
+def test_remote_read_lines_up_with_query_range():
+    start = datetime(2023, 3, 1, 10, 0, 0)
+    end = start + timedelta(minutes=30)
+    step = 10
+    # scraped every 15s with a gap longer than the lookback, zero values and a stale marker
+    timestamps = start.timestamp() - 100 + np.arange(140) * 15.0
+    timestamps = np.concatenate([timestamps[:40], timestamps[70:]]) + 0.003
+    series = list()
+    for index, (metric, instance) in enumerate([('node_load1', '10.0.0.1:9100'), ('node_load1', '10.0.0.2:9100'),
+                                                ('node_load5', '10.0.0.1:9100')]):
+        values = (np.arange(len(timestamps), dtype=np.float64) + index) % 7
+        values[90] = np.uint64(STALE_NAN).view(np.float64)
+        series.append(({'__name__': metric, 'instance': instance, 'job': 'node'}, timestamps, values))
+    metrics = ['node_load1', 'node_load5', 'node_load15']
+
+    with PrometheusServer(series) as server:
+        fetcher = PrometheusFetcher(server.url, step, workers=2)
+        try:
+            remote_read = dict(RemoteReader(fetcher).read_all(metrics, MATCHERS, start, end))
+            query_range = {metric: fetcher.query_range(metric, start, end) for metric in metrics}
+        finally:
+            fetcher.close()
+
+    assert server.paths.count("/api/v1/read") == 1
+    for metric in metrics:
+        expected = {frozenset(submetric['metric'].items()): submetric['values']
+                    for submetric in query_range[metric]['result']}
+        result = {frozenset(submetric['metric'].items()): [[float(timestamp), repr(float(sample))] for timestamp, sample
+                                                          in zip(*series_values(submetric))]
+                  for submetric in remote_read[metric]['result']}
+        assert result == expected
+    assert not remote_read['node_load15']['result']
@@ -0,0 +1,16 @@
+from datetime import datetime
+
+from openstack_tools.raw_metrics_store import RawMetricsStore, metric_instances
+
+
+def test_instances_of_filtered_out_metrics_are_kept(tmp_path):
+    store = RawMetricsStore(f"{tmp_path}/")
+    store.write_header(datetime(2023, 3, 1, 10), datetime(2023, 3, 1, 11), '{job=~"node"}',
+                       {'container_cpu_usage_seconds_total': ['10.0.0.1'],
+                        'node_load1': ['10.0.0.1', '10.0.0.2']}, {})
+    header = RawMetricsStore(f"{tmp_path}/").get_header()
+    # a denylist rebuild selecting only the container metrics
+    selected = [metric for metric in header['metrics'] if metric.startswith('container_')]
+
+    assert metric_instances({metric: header['metrics'][metric] for metric in selected}) == ['10.0.0.1']
+    assert metric_instances(header['metrics']) == ['10.0.0.1', '10.0.0.2']
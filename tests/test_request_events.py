@@ -0,0 +1,42 @@
+import threading
+import time
+
+from cloud_components import request_events
+
+
+def test_stream_blocks_while_other_deployment_publishes(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_events, "POLL_INTERVAL", 0.2)
+    monkeypatch.setattr(request_events, "STREAM_LIFETIME", 1)
+    iterations = {'value': 0}
+    events_after = request_events.events_after
+
+    def counting_events_after(deploy_id, sequence):
+        iterations['value'] += 1
+        return events_after(deploy_id, sequence)
+
+    monkeypatch.setattr(request_events, "events_after", counting_events_after)
+    log_path = tmp_path / "log"
+    log_path.write_text("")
+    stream = request_events.open_stream(1, {'log': str(log_path)})
+    request_events.publish(2, '{"id": 2}')
+
+    started = time.monotonic()
+    output = "".join(stream)
+
+    assert time.monotonic() - started >= 1
+    assert '"id": 2' not in output
+    # one iteration per poll interval, a spinning stream makes thousands
+    assert iterations['value'] <= 10
+
+
+def test_stream_wakes_on_own_deployment_event(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_events, "POLL_INTERVAL", 5)
+    log_path = tmp_path / "log"
+    log_path.write_text("")
+    stream = request_events.open_stream(3, {'log': str(log_path)})
+    assert next(stream).startswith("retry:")
+    threading.Timer(0.2, request_events.publish, args=[3, '{"id": 3}']).start()
+
+    started = time.monotonic()
+    assert '"id": 3' in next(stream)
+    assert time.monotonic() - started < 2
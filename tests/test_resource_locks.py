@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+from cloud_components.resource_locks import LOCK_EXCLUSIVE, LOCK_SHARED, conflicts, take_runnable
+
+START = datetime(2023, 3, 1, 10, 0, 0)
+NODES = ['wally101', 'wally102']
+
+
+def lifecycle(deploy_id):
+    return {('control', deploy_id): LOCK_EXCLUSIVE}
+
+
+def load(deploy_id):
+    resources = {('control', deploy_id): LOCK_SHARED, ('rally', deploy_id): LOCK_EXCLUSIVE}
+    resources.update({('node', node): LOCK_SHARED for node in NODES})
+    return resources
+
+
+def restart(deploy_id, node):
+    return {('control', deploy_id): LOCK_SHARED, ('node', node): LOCK_EXCLUSIVE}
+
+
+def request_test(deploy_id):
+    return {('control', deploy_id): LOCK_SHARED}
+
+
+def make_queue(*resources_list):
+    return [(START + timedelta(seconds=index), index + 1, 1, resources)
+            for index, resources in enumerate(resources_list)]
+
+
+def take_all(queue, running):
+    taken = list()
+    entry = take_runnable(queue, running)
+    while entry is not None:
+        taken.append(entry[1])
+        entry = take_runnable(queue, running)
+    return taken
+
+
+def test_conflicts_need_a_common_resource_locked_exclusively():
+    assert conflicts(lifecycle(1), request_test(1))
+    assert conflicts(load(1), restart(1, 'wally101'))
+    assert not conflicts(load(1), request_test(1))
+    assert not conflicts(restart(1, 'wally101'), restart(1, 'wally102'))
+    assert not conflicts(lifecycle(1), lifecycle(2))
+
+
+def test_independent_requests_start_together():
+    queue = make_queue(load(1), request_test(1), restart(1, 'wally103'))
+    running = {}
+
+    assert take_all(queue, running) == [1, 2, 3]
+    assert not queue
+
+
+def test_request_waits_for_a_running_conflict():
+    queue = make_queue(restart(1, 'wally101'), request_test(1))
+    running = {10: (1, load(1))}
+
+    assert take_all(queue, running) == [2]
+    del running[10]
+    assert take_all(queue, running) == [1]
+
+
+def test_later_requests_do_not_overtake_a_waiting_conflict():
+    # the load waits for the restart of its node, the next load for the first one, the test for neither
+    queue = make_queue(load(1), load(1), request_test(1))
+    running = {10: (1, restart(1, 'wally101'))}
+
+    assert take_all(queue, running) == [3]
+    del running[10]
+    assert take_all(queue, running) == [1]
+    del running[1]
+    assert take_all(queue, running) == [2]
+
+
+def test_lifecycle_request_holds_back_every_later_request_of_its_deployment():
+    queue = make_queue(request_test(1), lifecycle(1), request_test(1), request_test(2))
+    running = {}
+
+    assert take_all(queue, running) == [1, 4]
+    del running[1]
+    assert take_all(queue, running) == [2]
+    del running[2]
+    assert take_all(queue, running) == [3]
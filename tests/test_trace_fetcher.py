@@ -0,0 +1,32 @@
+import json
+import os
+
+from openstack_tools.trace_fetcher import build_trace_report
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as fixture:
+        return json.load(fixture)
+
+
+def test_report_matches_osprofiler():
+    # osprofiler_trace_report.json is the report the osprofiler driver built of these notifications
+    notifications = read_fixture("osprofiler_notifications.json")
+
+    report = build_trace_report(notifications)
+
+    assert json.loads(json.dumps(report)) == read_fixture("osprofiler_trace_report.json")
+
+
+def test_leaves_have_empty_children():
+    report = build_trace_report(read_fixture("osprofiler_notifications.json"))
+    nodes = list(report["children"])
+    leaves = 0
+    while nodes:
+        node = nodes.pop()
+        assert "children" in node
+        leaves += not node["children"]
+        nodes.extend(node["children"])
+    assert leaves == 3
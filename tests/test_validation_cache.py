@@ -0,0 +1,61 @@
+import os
+
+from openstack_tools import validation_cache
+from utils import get_deployment_folder
+
+
+def make_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(get_deployment_folder(1))
+    input_paths = [str(tmp_path / "task_source.yaml"), str(tmp_path / "rally.conf")]
+    for input_path in input_paths:
+        with open(input_path, "w") as input_file:
+            input_file.write(f"{os.path.basename(input_path)}\n")
+    return input_paths
+
+
+def test_stored_validation_is_a_hit(tmp_path, monkeypatch):
+    input_paths = make_inputs(tmp_path, monkeypatch)
+    validation_key = validation_cache.get_validation_key(1, input_paths)
+    assert not validation_cache.is_validated(1, validation_key)
+
+    validation_cache.store_validation(1, validation_key)
+
+    assert validation_cache.is_validated(1, validation_cache.get_validation_key(1, input_paths))
+
+
+def test_changed_input_or_deployment_is_a_miss(tmp_path, monkeypatch):
+    input_paths = make_inputs(tmp_path, monkeypatch)
+    validation_cache.store_validation(1, validation_cache.get_validation_key(1, input_paths))
+
+    assert validation_cache.get_validation_key(2, input_paths) != validation_cache.get_validation_key(1, input_paths)
+    with open(input_paths[1], "a") as config_file:
+        config_file.write("debug = True\n")
+    assert not validation_cache.is_validated(1, validation_cache.get_validation_key(1, input_paths))
+
+
+def test_content_moved_between_inputs_is_a_miss(tmp_path, monkeypatch):
+    input_paths = make_inputs(tmp_path, monkeypatch)
+    with open(input_paths[0], "w") as task_file:
+        task_file.write("ab")
+    with open(input_paths[1], "w") as config_file:
+        config_file.write("c")
+    validation_key = validation_cache.get_validation_key(1, input_paths)
+
+    with open(input_paths[0], "w") as task_file:
+        task_file.write("a")
+    with open(input_paths[1], "w") as config_file:
+        config_file.write("bc")
+
+    assert validation_cache.get_validation_key(1, input_paths) != validation_key
+
+
+def test_recreated_deployment_clears_the_cache(tmp_path, monkeypatch):
+    input_paths = make_inputs(tmp_path, monkeypatch)
+    validation_key = validation_cache.get_validation_key(1, input_paths)
+    validation_cache.store_validation(1, validation_key)
+
+    validation_cache.clear_validation_cache(1)
+
+    assert not validation_cache.is_validated(1, validation_key)
+    validation_cache.clear_validation_cache(1)